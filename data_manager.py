@@ -1,45 +1,188 @@
 # data_manager.py
 import os
-import json
+import time
+import atexit
+import queue
 import logging
+import threading
+import json_utils
 from config import PROCESSED_CIRCULARS_FILE, OUTPUT_JSON_FILE
 
 logger = logging.getLogger(__name__)
 
+# 抽出データは1件ずつJSON Linesに追記し、OUTPUT_JSON_FILE (JSON配列) はそこから書き出す
+OUTPUT_JSONL_FILE = os.path.splitext(OUTPUT_JSON_FILE)[0] + ".jsonl"
+
+PROCESSED_ID_FLUSH_EVERY = 50 # Number of pending IDs that triggers a flush to PROCESSED_CIRCULARS_FILE
+WRITER_FSYNC_INTERVAL_SECONDS = 5.0 # The writer thread fsyncs at most this often
+JSON_ARRAY_REWRITE_EVERY = 100 # New records that trigger a rewrite of OUTPUT_JSON_FILE
+JSON_ARRAY_REWRITE_INTERVAL_SECONDS = 600 # With records pending, this long since the last rewrite also triggers one
+
 def load_processed_ids():
     """処理済みCircular IDをファイルから読み込む"""
+    _WRITER.wait() # Include IDs still queued for the writer thread
     if not os.path.exists(PROCESSED_CIRCULARS_FILE):
         return set()
     try:
-        with open(PROCESSED_CIRCULARS_FILE, 'r', encoding='utf-8') as f:
-            return set(line.strip() for line in f if line.strip())
+        with open(PROCESSED_CIRCULARS_FILE, 'rb') as f:
+            data = f.read()
+        # bytes.split() with no argument splits on any whitespace in C and never yields empty items
+        return {circular_id.decode('utf-8') for circular_id in data.split()}
     except Exception as e:
         logger.error(f"Error loading processed IDs from {PROCESSED_CIRCULARS_FILE}: {e}")
         return set()
 
-def save_processed_id(circular_id):
-    """処理済みCircular IDをファイルに追記する"""
-    try:
-        # Ensure the directory for the processed IDs file exists
-        processed_ids_dir = os.path.dirname(PROCESSED_CIRCULARS_FILE)
-        if processed_ids_dir and not os.path.exists(processed_ids_dir):
-            os.makedirs(processed_ids_dir, exist_ok=True)
-            
-        with open(PROCESSED_CIRCULARS_FILE, 'a', encoding='utf-8') as f:
-            f.write(str(circular_id) + '\n') # Ensure ID is string
-    except Exception as e:
-        logger.error(f"Error saving processed ID {circular_id} to {PROCESSED_CIRCULARS_FILE}: {e}")
+class _BackgroundWriter:
+    """ファイルへの追記をキューで受け取り、専用のスレッドで書き込む (呼び出し側はディスクI/Oを待たない)"""
+
+    def __init__(self, fsync_interval):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._fsync_interval = fsync_interval
+
+    def submit(self, path, data):
+        """pathにdata (bytes) を追記するよう依頼する"""
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="data-writer", daemon=True)
+                self._thread.start()
+        self._queue.put((path, data))
+
+    def wait(self):
+        """依頼済みの書き込みがすべてファイルに反映されるまで待つ"""
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self):
+        """残りを書き込んでスレッドを終了する"""
+        with self._start_lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and thread.is_alive():
+            self._queue.put(None)
+            thread.join()
+
+    def _run(self):
+        handles = {} # One append handle per path, kept open for the thread's lifetime
+        last_fsync = time.monotonic()
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    break
+                path, data = item
+                f = handles.get(path)
+                if f is None:
+                    # Ensure the directory for the file exists
+                    file_dir = os.path.dirname(path)
+                    if file_dir and not os.path.exists(file_dir):
+                        os.makedirs(file_dir, exist_ok=True)
+                    f = handles[path] = open(path, 'ab')
+                f.write(data)
+                # Flush once the queue is drained (before task_done, so wait() sees the data on disk)
+                if self._queue.empty():
+                    do_fsync = time.monotonic() - last_fsync >= self._fsync_interval
+                    for handle in handles.values():
+                        handle.flush()
+                        if do_fsync:
+                            os.fsync(handle.fileno())
+                    if do_fsync:
+                        last_fsync = time.monotonic()
+            except Exception as e:
+                logger.error(f"Error writing to {item[0]}: {e}")
+            finally:
+                self._queue.task_done()
+        for handle in handles.values():
+            try:
+                handle.flush()
+                os.fsync(handle.fileno())
+                handle.close()
+            except OSError as e:
+                logger.error(f"Error closing {handle.name}: {e}")
+
+_WRITER = _BackgroundWriter(WRITER_FSYNC_INTERVAL_SECONDS)
+
+# Registered at import so that it runs after any ProcessedIdStore.flush registered later (atexit is LIFO)
+atexit.register(_WRITER.close)
+
+class ProcessedIdStore:
+    """処理済みCircular IDをメモリ上のsetで管理し、ファイルへの追記をまとめて行う"""
+
+    def __init__(self, flush_every=PROCESSED_ID_FLUSH_EVERY):
+        self._pending = []
+        self._flush_every = flush_every
+        atexit.register(self.flush)
+        self._ids = set()
+        self._max_numeric_id = None
+        if os.path.exists(PROCESSED_CIRCULARS_FILE):
+            self._ids = load_processed_ids()
+            self._max_numeric_id = max((int(c) for c in self._ids if c.isdigit()), default=None)
+        else:
+            self._rebuild_from_output()
+
+    def _rebuild_from_output(self):
+        """処理済みIDファイルが無い場合に限り、出力データ (JSON Lines) からIDを一度だけ再構築する"""
+        added = self.update(record['circular_id'] for record in iter_output_records() if record.get('circular_id') is not None)
+        if added:
+            logger.info(f"Rebuilt {added} processed IDs from {OUTPUT_JSONL_FILE}.")
+            self.flush()
+
+    def __contains__(self, circular_id):
+        return str(circular_id) in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    @property
+    def max_numeric_id(self):
+        """数値として最大の処理済みID (数値のIDが無ければNone)"""
+        return self._max_numeric_id
+
+    def add(self, circular_id):
+        """IDを処理済みとして記録する (ファイルへはflush時にまとめて書き込む)"""
+        circular_id = str(circular_id) # Ensure ID is string
+        if circular_id in self._ids:
+            return
+        self._ids.add(circular_id)
+        self._pending.append(circular_id)
+        if circular_id.isdigit() and (self._max_numeric_id is None or int(circular_id) > self._max_numeric_id):
+            self._max_numeric_id = int(circular_id)
+        if len(self._pending) >= self._flush_every:
+            self.flush()
+
+    def update(self, circular_ids):
+        """複数のIDをまとめて処理済みとして記録し、新たに追加された件数を返す"""
+        # dict.fromkeys dedupes while keeping the input order for the file
+        new_ids = [c for c in dict.fromkeys(map(str, circular_ids)) if c not in self._ids]
+        if not new_ids:
+            return 0
+        self._ids.update(new_ids)
+        self._pending.extend(new_ids)
+        highest = max((int(c) for c in new_ids if c.isdigit()), default=None)
+        if highest is not None and (self._max_numeric_id is None or highest > self._max_numeric_id):
+            self._max_numeric_id = highest
+        if len(self._pending) >= self._flush_every:
+            self.flush()
+        return len(new_ids)
 
-def load_output_data():
-    """既存の出力JSONデータを読み込む"""
+    def flush(self):
+        """未書き込みのIDをまとめて一度の書き込みとして書き込みスレッドに渡す"""
+        if not self._pending:
+            return
+        _WRITER.submit(PROCESSED_CIRCULARS_FILE, "".join(f"{circular_id}\n" for circular_id in self._pending).encode('utf-8'))
+        logger.debug(f"Queued {len(self._pending)} processed IDs for {PROCESSED_CIRCULARS_FILE}")
+        self._pending.clear()
+
+def _load_legacy_json_array():
+    """旧形式 (JSON配列) の出力JSONデータを読み込む"""
     if os.path.exists(OUTPUT_JSON_FILE):
         try:
-            with open(OUTPUT_JSON_FILE, 'r', encoding='utf-8') as f:
+            with open(OUTPUT_JSON_FILE, 'rb') as f:
                 content = f.read()
                 if not content.strip(): 
                     return []
-                return json.loads(content)
-        except json.JSONDecodeError:
+                return json_utils.loads(content)
+        except json_utils.JSONDecodeError:
             logger.warning(f"Could not decode JSON from {OUTPUT_JSON_FILE}. Attempting to backup and start fresh.")
             backup_file = OUTPUT_JSON_FILE + ".bak." + time.strftime("%Y%m%d%H%M%S")
             try:
@@ -53,23 +196,111 @@ def load_output_data():
             return []
     return []
 
-def save_output_data(data_list):
-    """抽出データをJSONファイルに保存する"""
+def append_output_record(record):
+    """抽出データ1件をJSON Linesファイルに追記する (書き込みはバックグラウンドで行う)"""
+    try:
+        _WRITER.submit(OUTPUT_JSONL_FILE, json_utils.dumps(record, append_newline=True))
+    except Exception as e:
+        logger.error(f"Error appending record {record.get('circular_id')} to {OUTPUT_JSONL_FILE}: {e}")
+
+def _iter_output_lines():
+    """JSON Linesファイルの有効な行を (生のバイト列, デコード結果) として1件ずつ返す"""
+    _WRITER.wait() # Include records still queued for the writer thread
+    if not os.path.exists(OUTPUT_JSONL_FILE):
+        return
+    with open(OUTPUT_JSONL_FILE, 'rb') as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield line, json_utils.loads(line)
+            except json_utils.JSONDecodeError:
+                logger.warning(f"Skipping undecodable line {line_no} in {OUTPUT_JSONL_FILE}.")
+
+def iter_output_records():
+    """JSON Linesファイルから抽出データを1件ずつ読み出す"""
+    try:
+        for _, record in _iter_output_lines():
+            yield record
+    except Exception as e:
+        logger.error(f"Error reading output records from {OUTPUT_JSONL_FILE}: {e}")
+
+def migrate_legacy_output():
+    """旧形式 (JSON配列) の出力ファイルしか無い場合、その内容をJSON Linesへ移行する"""
+    if not os.path.exists(OUTPUT_JSONL_FILE) and os.path.exists(OUTPUT_JSON_FILE):
+        legacy_data = _load_legacy_json_array()
+        if legacy_data:
+            logger.info(f"Migrating {len(legacy_data)} entries from {OUTPUT_JSON_FILE} to {OUTPUT_JSONL_FILE}.")
+            save_output_data(legacy_data)
+
+def materialize_json_array():
+    """JSON Linesファイルを1行ずつ読み、OUTPUT_JSON_FILEにJSON配列として書き出す"""
+    temp_file = OUTPUT_JSON_FILE + ".tmp"
     try:
         # Ensure the directory for the output file exists
         output_dir = os.path.dirname(OUTPUT_JSON_FILE)
         if output_dir and not os.path.exists(output_dir):
             os.makedirs(output_dir, exist_ok=True)
 
-        temp_file = OUTPUT_JSON_FILE + ".tmp"
-        with open(temp_file, 'w', encoding='utf-8') as f:
-            json.dump(data_list, f, indent=4, ensure_ascii=False)
-        os.replace(temp_file, OUTPUT_JSON_FILE) 
-        logger.debug(f"Data saved to {OUTPUT_JSON_FILE}")
+        with open(temp_file, 'wb') as f:
+            separator = b"[\n"
+            for line, _ in _iter_output_lines():
+                f.write(separator)
+                f.write(line)
+                separator = b",\n"
+            f.write(b"[]\n" if separator == b"[\n" else b"\n]\n")
+        os.replace(temp_file, OUTPUT_JSON_FILE)
+        logger.debug(f"Materialized {OUTPUT_JSONL_FILE} to {OUTPUT_JSON_FILE}")
     except Exception as e:
-        logger.error(f"Error saving output data to {OUTPUT_JSON_FILE}: {e}")
+        logger.error(f"Error writing JSON array to {OUTPUT_JSON_FILE}: {e}")
         if os.path.exists(temp_file):
             try:
                 os.remove(temp_file)
             except OSError:
-                pass
\ No newline at end of file
+                pass
+
+class JsonArrayMaterializer:
+    """OUTPUT_JSON_FILE (JSON配列) の全体書き直しを、未反映の件数か経過時間が閾値を超えたときだけ行う"""
+
+    def __init__(self, rewrite_every=JSON_ARRAY_REWRITE_EVERY, rewrite_interval=JSON_ARRAY_REWRITE_INTERVAL_SECONDS):
+        self._rewrite_every = rewrite_every
+        self._rewrite_interval = rewrite_interval
+        self._last_rewrite = time.monotonic()
+        # Catch up on records appended after the last rewrite of a previous run
+        self._dirty = 1 if _is_json_array_stale() else 0
+        atexit.register(self.maybe_materialize, force=True)
+
+    def mark_dirty(self, count=1):
+        """JSON Linesに追記された (まだJSON配列に反映されていない) 件数を記録する"""
+        self._dirty += count
+
+    def maybe_materialize(self, force=False):
+        """閾値を超えていれば (force=Trueなら未反映分があれば) JSON配列を書き出し、書き出したかを返す"""
+        if not self._dirty:
+            return False
+        if not force and self._dirty < self._rewrite_every and time.monotonic() - self._last_rewrite < self._rewrite_interval:
+            return False
+        logger.info(f"Writing JSON array with {self._dirty} new record(s).")
+        materialize_json_array()
+        self._dirty = 0
+        self._last_rewrite = time.monotonic()
+        return True
+
+def _is_json_array_stale():
+    """JSON LinesファイルがJSON配列より新しければTrue"""
+    if not os.path.exists(OUTPUT_JSONL_FILE):
+        return False
+    if not os.path.exists(OUTPUT_JSON_FILE):
+        return True
+    return os.path.getmtime(OUTPUT_JSONL_FILE) > os.path.getmtime(OUTPUT_JSON_FILE)
+
+def save_output_data(data_list):
+    """複数の抽出データをJSON Linesファイルにまとめて追記する (書き込みはバックグラウンドで行う)"""
+    if not data_list:
+        return
+    try:
+        _WRITER.submit(OUTPUT_JSONL_FILE, b"".join(json_utils.dumps(record, append_newline=True) for record in data_list))
+        logger.debug(f"Queued {len(data_list)} records for {OUTPUT_JSONL_FILE}")
+    except Exception as e:
+        logger.error(f"Error appending {len(data_list)} records to {OUTPUT_JSONL_FILE}: {e}")
@@ -4,6 +4,7 @@ import json
 import logging
 import sys
 import os
+import re
 from urllib.parse import urljoin
 
 from config import LOG_LEVEL, BASE_GCN_URL, SLACK_WEBHOOK_URL # SLACK_WEBHOOK_URLもインポート
@@ -19,8 +20,11 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Matches .../circulars/36789, .../circulars/36789/, .../circulars/36789#... and .../gcn3/36789.gcn3
+_CIRCULAR_ID_RE = re.compile(r'/(?:circulars|gcn3)/(\d+)')
 
-def debug_parse_url(circular_url_or_id, send_to_slack=False): # send_to_slack引数を追加
+
+def debug_parse_url(circular_url_or_id, send_to_slack=False, use_cache=True): # send_to_slack引数を追加
     """指定されたURLまたはIDのGCN Circularをパースし、LLMで情報を抽出する"""
     
     circular_id_str = ""
@@ -31,21 +35,11 @@ def debug_parse_url(circular_url_or_id, send_to_slack=False): # send_to_slack引
         circular_url_str = urljoin(BASE_GCN_URL, f"/circulars/{circular_id_str}")
     elif str(circular_url_or_id).startswith("http"):
         circular_url_str = str(circular_url_or_id)
-        try:
-            path_parts = circular_url_str.split('/')
-            potential_id = path_parts[-1]
-            if potential_id.isdigit():
-                circular_id_str = potential_id
-            elif path_parts[-2].isdigit() and (path_parts[-1] == '' or path_parts[-1].startswith('#')):
-                circular_id_str = path_parts[-2]
-            else:
-                id_from_url = potential_id.split('.')[0] 
-                if id_from_url.isdigit():
-                    circular_id_str = id_from_url
-                else:
-                    circular_id_str = "unknown_from_url"
-        except Exception as e:
-            logger.warning(f"Could not reliably determine circular ID from URL '{circular_url_str}': {e}")
+        match = _CIRCULAR_ID_RE.search(circular_url_str)
+        if match:
+            circular_id_str = match.group(1)
+        else:
+            logger.warning(f"Could not reliably determine circular ID from URL '{circular_url_str}'")
             circular_id_str = "unknown_from_url"
     else:
         logger.error(f"Invalid input: {circular_url_or_id}. Please provide a full URL or a GCN circular ID.")
@@ -57,7 +51,7 @@ def debug_parse_url(circular_url_or_id, send_to_slack=False): # send_to_slack引
         
     logger.info(f"Processing Circular ID: {circular_id_str}, URL: {circular_url_str}")
 
-    raw_text = get_circular_text_robust(circular_id_str, circular_url_str)
+    raw_text = get_circular_text_robust(circular_id_str, circular_url_str, use_cache=use_cache)
 
     extracted_info = None # 初期化
     if not raw_text:
@@ -67,7 +61,7 @@ def debug_parse_url(circular_url_or_id, send_to_slack=False): # send_to_slack引
     else:
         logger.info(f"Raw text retrieved (first 300 chars):\n{raw_text[:300]}...")
         subject_debug = f"Debug parsing for circular {circular_id_str}"
-        extracted_info = extract_info_with_llm(raw_text, circular_id_str, circular_url_str, subject_debug)
+        extracted_info = extract_info_with_llm(raw_text, circular_id_str, circular_url_str, subject_debug, use_cache=use_cache)
     
     print("\n--- Extracted Information (JSON) ---")
     print(json.dumps(extracted_info, indent=4, ensure_ascii=False))
@@ -89,7 +83,8 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Debug GCN Circular Parser and LLM Extractor.")
     parser.add_argument("url_or_id", help="Full URL of the GCN circular (e.g., 'https://gcn.nasa.gov/circulars/36789') or just the ID (e.g., '36789').")
     parser.add_argument("--slack", action="store_true", help="Send the parsed result to Slack (if configured).") # Slackフラグ追加
+    parser.add_argument("--no-cache", action="store_true", help="Always fetch the circular text from GCN and re-run the LLM instead of using the on-disk caches.")
     
     args = parser.parse_args()
     
-    debug_parse_url(args.url_or_id, args.slack) # slackフラグを渡す
\ No newline at end of file
+    debug_parse_url(args.url_or_id, args.slack, use_cache=not args.no_cache) # slackフラグを渡す
\ No newline at end of file
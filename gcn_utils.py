@@ -1,109 +1,255 @@
 # gcn_utils.py
+import os
+import functools
+import inspect
 import requests
+from requests.adapters import HTTPAdapter
+from requests.compat import chardet
+from urllib3.util import Retry, make_headers
 from bs4 import BeautifulSoup
 from urllib.parse import urljoin
 import logging
-from config import GCN_CIRCULARS_INDEX_URL, BASE_GCN_URL, REQUEST_TIMEOUT
+import config
+from config import GCN_CIRCULARS_INDEX_URL, BASE_GCN_URL, REQUEST_TIMEOUT, PROCESSED_CIRCULARS_FILE
 
 logger = logging.getLogger(__name__)
 
+# --- HTMLパーサー (lxmlがあればCパーサーを使う) ---
+try:
+    from lxml import etree as lxml_etree
+    from lxml import html as lxml_html
+    _BS_PARSER = 'lxml'
+except ImportError:
+    lxml_etree = None
+    lxml_html = None
+    _BS_PARSER = 'html.parser'
+
+# --- HTTPセッション (keep-aliveで接続を再利用する) ---
+FETCH_MAX_RETRIES = 3
+FETCH_RETRY_BACKOFF_FACTOR = 0.5 # Sleep backoff_factor * 2**attempt seconds between attempts
+FETCH_RETRY_STATUSES = frozenset([500, 502, 503, 504])
+
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=50,
+    max_retries=Retry(total=FETCH_MAX_RETRIES, backoff_factor=FETCH_RETRY_BACKOFF_FACTOR, status_forcelist=FETCH_RETRY_STATUSES)
+))
+# Advertise every content coding urllib3 can decode here (br/zstd only when their packages are installed)
+_SESSION.headers.update({
+    'Accept-Encoding': make_headers(accept_encoding=True)['accept-encoding'],
+    'User-Agent': 'gcn_monitor/1.0'
+})
+
+# --- 一覧ページのストリーミング取得 ---
+INDEX_CHUNK_SIZE = 64 * 1024 # Bytes fed to the streaming index parser at a time
+
+# --- Circular本文の判定 ---
+_PLACEHOLDER_PREFIXES = ("The GCN Circular system is evolving.", "This GCN Circular is currently unavailable.")
+MIN_CIRCULAR_TEXT_LENGTH = 50 # Shorter HTML text triggers the .gcn3 fallback, so anything still shorter is not a circular
+
+# --- Circular本文のディスクキャッシュ ---
+# CACHE_DIR is optional in config.py; by default the cache lives next to the data files
+CIRCULAR_TEXT_CACHE_DIR = getattr(config, "CACHE_DIR", os.path.join(os.path.dirname(PROCESSED_CIRCULARS_FILE), "cache"))
+
+def _declared_encoding(encoding):
+    """ヘッダーで宣言された文字コードを返す (requestsが補うISO-8859-1は宣言なしとみなす)"""
+    return encoding if encoding and encoding.lower() != 'iso-8859-1' else None
+
+def _decode_content(content, declared_encoding):
+    """
+    レスポンス本文を一度だけデコードする。
+    ヘッダーのcharsetを信頼し、指定が無い場合 (requestsはISO-8859-1として報告する) はUTF-8とみなす。
+    デコードに失敗した場合のみ先頭部分で文字コードを推定する。
+    """
+    encoding = _declared_encoding(declared_encoding) or 'utf-8'
+    try:
+        return content.decode(encoding)
+    except (UnicodeDecodeError, LookupError):
+        detected = chardet.detect(content[:4096]).get('encoding') if chardet else None
+        logger.debug(f"Could not decode content as {encoding}; falling back to detected encoding {detected}.")
+        try:
+            return content.decode(detected or 'utf-8', errors='replace')
+        except LookupError:
+            return content.decode('utf-8', errors='replace')
+
 def get_page_content(url):
     """指定されたURLからページのHTMLコンテンツを取得する"""
     try:
-        response = requests.get(url, timeout=REQUEST_TIMEOUT)
+        response = _SESSION.get(url, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
-        response.encoding = response.apparent_encoding
-        if response.encoding.lower() == 'iso-8859-1' and 'utf-8' in response.text.lower():
-             response.encoding = 'utf-8'
-        return response.text
+        return _decode_content(response.content, response.encoding)
     except requests.exceptions.RequestException as e:
         logger.error(f"Error fetching page {url}: {e}")
         return None
 
-def parse_gcn_circular_list(html_content):
-    """GCN Circulars一覧ページをパースして、各Circularの情報を取得する"""
-    if not html_content:
-        return []
-    soup = BeautifulSoup(html_content, 'html.parser')
+def _circular_from_pre_link(href, text, subject_text):
+    """<pre>形式の一覧にあるリンク1件からCircular情報を作る (対象外ならNone)"""
+    if not ((href.endswith('.gcn3') and text.isdigit()) or \
+            (href.startswith('/circulars/') and href.split('/')[-1].isdigit())):
+        return None
+
+    circular_id = text if text.isdigit() else href.split('/')[-1].replace('.gcn3', '')
+    if not circular_id.isdigit():
+        return None
+
+    if href.endswith('.gcn3'):
+        detail_page_url = urljoin(BASE_GCN_URL, f"/circulars/{circular_id}")
+    else:
+        detail_page_url = urljoin(BASE_GCN_URL, href)
+
+    subject = subject_text.strip() if subject_text and isinstance(subject_text, str) else f"Subject for {circular_id}"
+    return {
+        'id': circular_id,
+        'url': detail_page_url,
+        'subject': subject
+    }
+
+def _circular_from_table_row(circular_id_text, relative_url, subject):
+    """一覧テーブルの1行からCircular情報を作る (対象外ならNone)"""
+    if not circular_id_text.isdigit():
+        return None
+
+    if relative_url.endswith('.gcn3'):
+        potential_id = relative_url.split('/')[-1].replace('.gcn3', '')
+        if not potential_id.isdigit():
+            return None
+        circular_id = potential_id
+        circular_url = urljoin(BASE_GCN_URL, f"/circulars/{circular_id}")
+    elif relative_url.startswith('/circulars/'):
+        circular_id = circular_id_text
+        circular_url = urljoin(BASE_GCN_URL, relative_url)
+    else:
+        return None
+
+    return {
+        'id': circular_id,
+        'url': circular_url,
+        'subject': subject
+    }
+
+def _parse_gcn_circular_list_soup(html_content):
+    """BeautifulSoupで一覧ページ全体をパースする (lxmlが無い場合のフォールバック)"""
+    soup = BeautifulSoup(html_content, _BS_PARSER)
     circulars = []
     
     table = soup.find('table')
     if not table:
-        pre_tags = soup.find_all('pre')
-        if pre_tags:
-            for pre_tag in pre_tags:
-                links = pre_tag.find_all('a', href=True)
-                for link in links:
-                    href = link['href']
-                    text = link.text.strip()
-                    if (href.endswith('.gcn3') and text.isdigit()) or \
-                       (href.startswith('/circulars/') and href.split('/')[-1].isdigit()):
-                        
-                        circular_id = text if text.isdigit() else href.split('/')[-1].replace('.gcn3', '')
-                        if not circular_id.isdigit(): continue
-
-                        if href.endswith('.gcn3'):
-                            detail_page_url = urljoin(BASE_GCN_URL, f"/circulars/{circular_id}")
-                        else:
-                            detail_page_url = urljoin(BASE_GCN_URL, href)
-
-                        subject_text = link.next_sibling
-                        subject = subject_text.strip() if subject_text and isinstance(subject_text, str) else f"Subject for {circular_id}"
-
-                        circulars.append({
-                            'id': circular_id,
-                            'url': detail_page_url,
-                            'subject': subject
-                        })
-            if circulars:
-                logger.info(f"Parsed {len(circulars)} circulars from <pre> tags.")
-                return circulars
+        for pre_tag in soup.find_all('pre'):
+            for link in pre_tag.find_all('a', href=True):
+                circular = _circular_from_pre_link(link['href'], link.text.strip(), link.next_sibling)
+                if circular:
+                    circulars.append(circular)
+        if circulars:
+            logger.info(f"Parsed {len(circulars)} circulars from <pre> tags.")
+            return circulars
         logger.warning("Could not find the main table or <pre> tags in GCN circulars list.")
         return []
         
-    for row in table.find_all('tr'):
+    # Only rows that contain a linked cell can describe a circular
+    for row in table.select('tr:has(td a[href])'):
         cells = row.find_all('td')
         if len(cells) > 1: 
             link_tag = cells[0].find('a')
             if link_tag and link_tag.has_attr('href'):
-                circular_id_text = link_tag.text.strip()
-                if not circular_id_text.isdigit():
-                    continue
-
-                relative_url = link_tag['href']
-                circular_id = ""
-                circular_url = ""
-
-                if relative_url.endswith('.gcn3'):
-                    potential_id = relative_url.split('/')[-1].replace('.gcn3', '')
-                    if potential_id.isdigit():
-                        circular_id = potential_id
-                        circular_url = urljoin(BASE_GCN_URL, f"/circulars/{circular_id}")
-                    else:
-                        continue
-                elif relative_url.startswith('/circulars/'):
-                    circular_id = circular_id_text
-                    circular_url = urljoin(BASE_GCN_URL, relative_url)
-                else:
-                    continue
-                
-                subject = cells[1].text.strip() if len(cells) > 1 else None
-                
-                circulars.append({
-                    'id': circular_id,
-                    'url': circular_url,
-                    'subject': subject
-                })
+                circular = _circular_from_table_row(link_tag.text.strip(), link_tag['href'], cells[1].text.strip())
+                if circular:
+                    circulars.append(circular)
     logger.info(f"Parsed {len(circulars)} circulars from table.")
     return circulars
 
-def get_circular_raw_text_from_page(circular_page_url):
-    """個別のCircularページ (HTML) から本文テキストを取得する"""
-    html_content = get_page_content(circular_page_url)
-    if not html_content:
-        return None
-    
-    soup = BeautifulSoup(html_content, 'html.parser')
+def _element_text(elem):
+    """lxml要素の (子孫を含む) テキストを前後の空白を除いて返す"""
+    return "".join(elem.itertext()).strip()
+
+class CircularListStreamParser:
+    """
+    GCN Circulars一覧ページをチャンク単位でパースする。
+    <tr> (と旧形式の<pre>) の閉じタグごとにCircular情報を取り出し、処理済みの要素は破棄してメモリを抑える。
+    """
+
+    def __init__(self, encoding=None):
+        # Like _decode_content, a missing charset means UTF-8 (lxml would otherwise assume Latin-1)
+        self._parser = lxml_etree.HTMLPullParser(events=('end',), tag=('tr', 'pre'), encoding=_declared_encoding(encoding) or 'utf-8')
+        self.table_count = 0
+        self.pre_count = 0
+
+    def feed(self, chunk):
+        """チャンクを投入し、この時点で確定したCircular情報のリストを返す"""
+        self._parser.feed(chunk)
+        return self._drain()
+
+    def close(self):
+        """入力の終わりを通知し、残りのCircular情報のリストを返す"""
+        self._parser.close()
+        return self._drain()
+
+    def _drain(self):
+        circulars = []
+        for _, elem in self._parser.read_events():
+            if elem.tag == 'tr':
+                circular = self._parse_row(elem)
+                if circular:
+                    circulars.append(circular)
+                    self.table_count += 1
+            elif self.table_count == 0: # <pre> listing is only a fallback for pages without a table
+                for link in elem.iter('a'):
+                    href = link.get('href')
+                    if not href:
+                        continue
+                    circular = _circular_from_pre_link(href, _element_text(link), link.tail)
+                    if circular:
+                        circulars.append(circular)
+                        self.pre_count += 1
+            # Drop the finished element and everything before it
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        return circulars
+
+    def log_summary(self):
+        if self.table_count:
+            logger.info(f"Parsed {self.table_count} circulars from table.")
+        elif self.pre_count:
+            logger.info(f"Parsed {self.pre_count} circulars from <pre> tags.")
+        else:
+            logger.warning("Could not find any circulars in the table or <pre> tags of GCN circulars list.")
+
+    @staticmethod
+    def _parse_row(row):
+        cells = row.findall('td')
+        if len(cells) <= 1:
+            return None
+        link_tag = cells[0].find('.//a')
+        if link_tag is None or not link_tag.get('href'):
+            return None
+        return _circular_from_table_row(_element_text(link_tag), link_tag.get('href'), _element_text(cells[1]))
+
+def parse_gcn_circular_list(content, encoding=None):
+    """
+    GCN Circulars一覧ページをパースして、各Circularの情報を1件ずつ返すジェネレータ。
+    contentはHTML全体 (str/bytes) またはバイト列チャンクのイテラブル。
+    """
+    if not content:
+        return
+    if isinstance(content, str):
+        content, encoding = [content.encode('utf-8')], 'utf-8'
+    elif isinstance(content, bytes):
+        content = [content]
+
+    if lxml_etree is None:
+        yield from _parse_gcn_circular_list_soup(b"".join(content))
+        return
+
+    parser = CircularListStreamParser(encoding)
+    for chunk in content:
+        yield from parser.feed(chunk)
+    yield from parser.close()
+    parser.log_summary()
+
+def _extract_circular_text_soup(html_content, circular_page_url):
+    """BeautifulSoupでCircularページから本文テキストを取り出す (lxmlが無い場合のフォールバック)"""
+    soup = BeautifulSoup(html_content, _BS_PARSER)
     pre_tag = soup.find('pre')
     if pre_tag:
         return pre_tag.text.strip()
@@ -116,45 +262,166 @@ def get_circular_raw_text_from_page(circular_page_url):
             return body_tag.get_text(separator='\n', strip=True)
         return None
 
+def extract_circular_text(html_content, circular_page_url):
+    """CircularページのHTMLから本文テキストを取り出す (lxmlがあればBeautifulSoupを介さずに直接読む)"""
+    if lxml_html is None:
+        return _extract_circular_text_soup(html_content, circular_page_url)
+    try:
+        tree = lxml_html.fromstring(html_content)
+    except (ValueError, lxml_etree.ParserError) as e:
+        logger.debug(f"lxml could not parse {circular_page_url} ({e}); falling back to BeautifulSoup.")
+        return _extract_circular_text_soup(html_content, circular_page_url)
+
+    pre_tag = tree.find('.//pre')
+    if pre_tag is not None:
+        return pre_tag.text_content().strip()
+
+    logger.warning(f"No <pre> tag found in {circular_page_url}. Attempting to extract from body, may include noise.")
+    body_tag = tree.find('.//body')
+    if body_tag is None:
+        return None
+    for s in list(body_tag.iter('script', 'style')):
+        s.drop_tree()
+    return "\n".join(text.strip() for text in body_tag.itertext() if text.strip())
+
+def get_circular_raw_text_from_page(circular_page_url):
+    """個別のCircularページ (HTML) から本文テキストを取得する"""
+    html_content = get_page_content(circular_page_url)
+    if not html_content:
+        return None
+    return extract_circular_text(html_content, circular_page_url)
+
 def get_circular_raw_text_from_gcn3_file(gcn3_url):
     """ .gcn3 ファイルから直接テキストを取得する (フォールバック用) """
     try:
-        response = requests.get(gcn3_url, timeout=REQUEST_TIMEOUT)
+        response = _SESSION.get(gcn3_url, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
-        response.encoding = response.apparent_encoding
-        if response.encoding.lower() == 'iso-8859-1' and 'utf-8' in response.text.lower():
-             response.encoding = 'utf-8'
-        return response.text.strip()
+        return _decode_content(response.content, response.encoding).strip()
     except requests.exceptions.RequestException as e:
         logger.error(f"Error fetching .gcn3 file {gcn3_url}: {e}")
         return None
 
+def is_placeholder_text(text):
+    """GCNサイトが本文の代わりに表示するプレースホルダーかどうかを判定する"""
+    return text.strip().startswith(_PLACEHOLDER_PREFIXES)
+
+def is_substantive_text(text):
+    """テキストが短すぎず、プレースホルダーでもないかを判定する"""
+    return bool(text) and len(text) >= MIN_CIRCULAR_TEXT_LENGTH and not is_placeholder_text(text)
+
+def looks_like_valid_circular(text):
+    """
+    テキストがGCN Circularの本文らしいかを安価に判定する (LLMに渡す前のプレフィルタ)。
+    短すぎるものとプレースホルダーは対象外とする (HTMLページの本文にはSUBJECT/TITLEヘッダー行が無いため、ヘッダーでは判定しない)。
+    """
+    return is_substantive_text(text)
+
+def _drop_placeholder_text(circular_id, raw_text):
+    """HTMLページから得たテキストがプレースホルダーならNoneを返す"""
+    if raw_text and len(raw_text) > 50 and is_placeholder_text(raw_text):
+        logger.warning(f"Circular {circular_id} page content seems to be a placeholder. Trying .gcn3 file.")
+        return None
+    return raw_text
+
+def _needs_gcn3_fallback(raw_text):
+    return not raw_text or len(raw_text) < MIN_CIRCULAR_TEXT_LENGTH
+
+def _gcn3_file_url(circular_id):
+    return urljoin(BASE_GCN_URL, f"/gcn3/{circular_id}.gcn3")
+
+def _pick_circular_text(circular_id, raw_text, raw_text_gcn3, gcn3_file_url):
+    """HTMLページと.gcn3ファイルから得たテキストのうち良い方を返す"""
+    if raw_text_gcn3 and len(raw_text_gcn3) > len(raw_text or ""): 
+        logger.info(f"Successfully fetched text from {gcn3_file_url}")
+        return raw_text_gcn3
+    elif raw_text:
+         logger.info(f"Using text from HTML page as .gcn3 was not better or also failed.")
+         return raw_text
+    else:
+        logger.warning(f"Could not retrieve valid text from HTML page or .gcn3 file for circular {circular_id}.")
+        return None
+
+def _circular_text_cache_path(cache_dir, circular_id):
+    return os.path.join(cache_dir, f"{os.path.basename(str(circular_id))}.txt")
+
+def read_cached_circular_text(circular_id, cache_dir=CIRCULAR_TEXT_CACHE_DIR):
+    """キャッシュ済みのCircular本文を返す (無ければNone)"""
+    path = _circular_text_cache_path(cache_dir, circular_id)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            cached = f.read()
+    except OSError as e:
+        logger.warning(f"Could not read cached text {path}: {e}")
+        return None
+    # Entries written before short/placeholder text was excluded are ignored so the text is fetched again
+    return cached if is_substantive_text(cached) else None
+
+def write_cached_circular_text(circular_id, raw_text, cache_dir=CIRCULAR_TEXT_CACHE_DIR):
+    """Circular本文をキャッシュに書き込む (一時ファイル経由で置き換える)"""
+    path = _circular_text_cache_path(cache_dir, circular_id)
+    temp_file = path + ".tmp"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            f.write(raw_text)
+        os.replace(temp_file, path)
+    except OSError as e:
+        logger.warning(f"Could not write cached text {path}: {e}")
+
+def disk_cache(cache_dir=CIRCULAR_TEXT_CACHE_DIR):
+    """
+    circular_id を引数に持つ本文取得関数 (同期/非同期) の結果をディスクにキャッシュするデコレータ。
+    呼び出し時に use_cache=False を渡すとキャッシュを読み書きしない。取得に失敗した結果や、短すぎる・プレースホルダーのテキストはキャッシュしない。
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        def circular_id_of(args, kwargs):
+            return signature.bind(*args, **kwargs).arguments['circular_id']
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, use_cache=True, **kwargs):
+                circular_id = circular_id_of(args, kwargs)
+                cached = read_cached_circular_text(circular_id, cache_dir) if use_cache else None
+                if cached is not None:
+                    logger.info(f"Using cached text for circular {circular_id}.")
+                    return cached
+                raw_text = await func(*args, **kwargs)
+                if use_cache and is_substantive_text(raw_text):
+                    write_cached_circular_text(circular_id, raw_text, cache_dir)
+                return raw_text
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, use_cache=True, **kwargs):
+            circular_id = circular_id_of(args, kwargs)
+            cached = read_cached_circular_text(circular_id, cache_dir) if use_cache else None
+            if cached is not None:
+                logger.info(f"Using cached text for circular {circular_id}.")
+                return cached
+            raw_text = func(*args, **kwargs)
+            if use_cache and is_substantive_text(raw_text): # Short/placeholder text may be replaced by .gcn3 later
+                write_cached_circular_text(circular_id, raw_text, cache_dir)
+            return raw_text
+        return wrapper
+    return decorator
+
+@disk_cache()
 def get_circular_text_robust(circular_id, circular_page_url):
     """
     GCN Circularの本文テキストを取得する。
     まずHTMLページを試し、失敗したらgcn3ファイル直リンクも試す。
     """
     logger.info(f"Attempting to get text for circular {circular_id} from page: {circular_page_url}")
-    raw_text = get_circular_raw_text_from_page(circular_page_url)
-    
-    if raw_text and len(raw_text) > 50:
-        if raw_text.strip().startswith("The GCN Circular system is evolving.") or \
-           raw_text.strip().startswith("This GCN Circular is currently unavailable."):
-            logger.warning(f"Circular {circular_id} page content seems to be a placeholder. Trying .gcn3 file.")
-            raw_text = None 
-
-    if not raw_text or len(raw_text) < 50 : 
-        gcn3_file_url = urljoin(BASE_GCN_URL, f"/gcn3/{circular_id}.gcn3")
+    raw_text = _drop_placeholder_text(circular_id, get_circular_raw_text_from_page(circular_page_url))
+
+    if _needs_gcn3_fallback(raw_text): 
+        gcn3_file_url = _gcn3_file_url(circular_id)
         logger.info(f"Failed to get sufficient text from HTML page or text was short/placeholder. Trying .gcn3 file: {gcn3_file_url}")
         raw_text_gcn3 = get_circular_raw_text_from_gcn3_file(gcn3_file_url)
-        if raw_text_gcn3 and len(raw_text_gcn3) > len(raw_text or ""): 
-            logger.info(f"Successfully fetched text from {gcn3_file_url}")
-            return raw_text_gcn3
-        elif raw_text:
-             logger.info(f"Using text from HTML page as .gcn3 was not better or also failed.")
-             return raw_text
-        else:
-            logger.warning(f"Could not retrieve valid text from HTML page or .gcn3 file for circular {circular_id}.")
-            return None
+        return _pick_circular_text(circular_id, raw_text, raw_text_gcn3, gcn3_file_url)
             
-    return raw_text
\ No newline at end of file
+    return raw_text
@@ -0,0 +1,109 @@
+# gcn_utils_async.py
+import asyncio
+import logging
+import aiohttp
+from config import GCN_CIRCULARS_INDEX_URL, REQUEST_TIMEOUT
+from gcn_utils import (
+    lxml_etree, INDEX_CHUNK_SIZE, FETCH_MAX_RETRIES, FETCH_RETRY_BACKOFF_FACTOR, FETCH_RETRY_STATUSES, CircularListStreamParser,
+    parse_gcn_circular_list, extract_circular_text, disk_cache,
+    _decode_content, _drop_placeholder_text, _needs_gcn3_fallback, _gcn3_file_url, _pick_circular_text
+)
+
+logger = logging.getLogger(__name__)
+
+# --- aiohttpコネクタの設定 ---
+ASYNC_CONNECTION_LIMIT = 100
+ASYNC_LIMIT_PER_HOST = 10
+ASYNC_KEEPALIVE_TIMEOUT = 30 # Seconds an idle connection is kept for reuse
+
+def create_client_session():
+    """GCN取得用のaiohttpセッションを作成する (イベントループ内で呼び出すこと)"""
+    connector = aiohttp.TCPConnector(
+        limit=ASYNC_CONNECTION_LIMIT,
+        limit_per_host=ASYNC_LIMIT_PER_HOST,
+        keepalive_timeout=ASYNC_KEEPALIVE_TIMEOUT
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+        headers={'User-Agent': 'gcn_monitor/1.0'}
+    )
+
+async def _fetch_text_async(session, url, description):
+    """
+    urlを取得してデコードした文字列を返す (失敗時はNone)。
+    5xxと接続エラーは同期版のセッションのRetryと同じく最大FETCH_MAX_RETRIES回まで再試行する。
+    """
+    for attempt in range(FETCH_MAX_RETRIES + 1):
+        try:
+            async with session.get(url) as response:
+                if response.status not in FETCH_RETRY_STATUSES or attempt == FETCH_MAX_RETRIES:
+                    response.raise_for_status()
+                    return _decode_content(await response.read(), response.charset)
+                logger.warning(f"HTTP {response.status} fetching {description} {url}; retrying ({attempt + 1}/{FETCH_MAX_RETRIES})")
+        except aiohttp.ClientResponseError as e: # 4xx, or a 5xx that persisted through every retry
+            logger.error(f"Error fetching {description} {url}: {e}")
+            return None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == FETCH_MAX_RETRIES:
+                logger.error(f"Error fetching {description} {url}: {e}")
+                return None
+            logger.warning(f"Error fetching {description} {url}: {e}; retrying ({attempt + 1}/{FETCH_MAX_RETRIES})")
+        await asyncio.sleep(FETCH_RETRY_BACKOFF_FACTOR * (2 ** attempt))
+    return None
+
+async def get_page_content_async(session, url):
+    """指定されたURLからページのHTMLコンテンツを非同期に取得する"""
+    return await _fetch_text_async(session, url, "page")
+
+async def iter_gcn_circular_list_async(session, url=GCN_CIRCULARS_INDEX_URL):
+    """
+    GCN Circulars一覧ページを非同期にストリーミング取得しながらパースし、各Circularの情報を1件ずつ返す。
+    取得に失敗した場合はエラーをログに出して終了する。
+    """
+    try:
+        async with session.get(url) as response:
+            response.raise_for_status()
+            if lxml_etree is None:
+                for circular in parse_gcn_circular_list(_decode_content(await response.read(), response.charset)):
+                    yield circular
+                return
+
+            parser = CircularListStreamParser(response.charset)
+            async for chunk in response.content.iter_chunked(INDEX_CHUNK_SIZE):
+                for circular in parser.feed(chunk):
+                    yield circular
+            for circular in parser.close():
+                yield circular
+            parser.log_summary()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error(f"Error fetching page {url}: {e}")
+
+async def get_circular_raw_text_from_page_async(session, circular_page_url):
+    """個別のCircularページ (HTML) から本文テキストを非同期に取得する"""
+    html_content = await get_page_content_async(session, circular_page_url)
+    if not html_content:
+        return None
+    return extract_circular_text(html_content, circular_page_url)
+
+async def get_circular_raw_text_from_gcn3_file_async(session, gcn3_url):
+    """ .gcn3 ファイルから直接テキストを非同期に取得する (フォールバック用) """
+    text = await _fetch_text_async(session, gcn3_url, ".gcn3 file")
+    return text.strip() if text is not None else None
+
+@disk_cache()
+async def get_circular_text_robust_async(session, circular_id, circular_page_url):
+    """
+    get_circular_text_robust の非同期版。
+    まずHTMLページを試し、失敗したらgcn3ファイル直リンクも試す。
+    """
+    logger.info(f"Attempting to get text for circular {circular_id} from page: {circular_page_url}")
+    raw_text = _drop_placeholder_text(circular_id, await get_circular_raw_text_from_page_async(session, circular_page_url))
+
+    if _needs_gcn3_fallback(raw_text):
+        gcn3_file_url = _gcn3_file_url(circular_id)
+        logger.info(f"Failed to get sufficient text from HTML page or text was short/placeholder. Trying .gcn3 file: {gcn3_file_url}")
+        raw_text_gcn3 = await get_circular_raw_text_from_gcn3_file_async(session, gcn3_file_url)
+        return _pick_circular_text(circular_id, raw_text, raw_text_gcn3, gcn3_file_url)
+
+    return raw_text
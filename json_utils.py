@@ -0,0 +1,27 @@
+# json_utils.py
+import json
+
+try:
+    import orjson
+except ImportError: # orjson is optional; fall back to the standard library
+    orjson = None
+
+# orjson.JSONDecodeError is a subclass of json.JSONDecodeError, so callers can catch this in both cases.
+JSONDecodeError = json.JSONDecodeError
+
+def dumps(obj, indent=False, append_newline=False):
+    """オブジェクトをUTF-8のJSONバイト列にシリアライズする (append_newline=Trueで末尾に改行を付ける)"""
+    if orjson is not None:
+        option = (orjson.OPT_INDENT_2 if indent else 0) | (orjson.OPT_APPEND_NEWLINE if append_newline else 0)
+        return orjson.dumps(obj, option=option)
+    if indent:
+        content = json.dumps(obj, indent=2, ensure_ascii=False)
+    else:
+        content = json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+    return (content + "\n" if append_newline else content).encode('utf-8')
+
+def loads(content):
+    """JSONのバイト列または文字列をデシリアライズする"""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
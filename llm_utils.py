@@ -1,12 +1,43 @@
 # llm_utils.py
+import os
 import requests
-import json
+from requests.adapters import HTTPAdapter
 import logging
 import time
+import random
+import re
+import math
+import sqlite3
+import hashlib
+import threading
+import functools
+from typing import Any
+import msgspec
+import json_utils
+from gcn_utils import looks_like_valid_circular, CIRCULAR_TEXT_CACHE_DIR
 from config import OLLAMA_API_URL, LLM_MODEL, MAX_RETRIES_LLM, REQUEST_TIMEOUT
 
 logger = logging.getLogger(__name__)
 
+# --- HTTPセッション (Ollamaへの接続を再利用する) ---
+# Retries are handled by the loop in extract_info_with_llm, so the adapter only pools.
+_SESSION = requests.Session()
+_SESSION.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+_SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+LLM_CONNECT_TIMEOUT = 5 # Seconds; the read timeout stays REQUEST_TIMEOUT because generation is slow
+LLM_MAX_BACKOFF_SECONDS = 60
+
+# --- Ollamaの生成オプション ---
+# Deterministic, bounded generation: the JSON answer fits well within num_predict tokens
+LLM_OPTIONS = {
+    "temperature": 0.0,
+    "top_p": 0.1,
+    "num_predict": 512,
+    "stop": ["\n\n\n", "```"]
+}
+LLM_KEEP_ALIVE = "5m" # Keep the model loaded between circulars to avoid reload latency
+
 # --- JSON Schema (Python辞書として) ---
 JSON_SCHEMA_DICT = {
     "$schema": "http://json-schema.org/draft-07/schema#",
@@ -36,39 +67,38 @@ JSON_SCHEMA_DICT = {
     "required": ["circular_id", "circular_url", "raw_text", "extraction_successful"]
 }
 
+# Schema defaults computed once: boolean flags default to False, everything else to None
+_BOOLEAN_FLAG_KEYS = ("is_trigger_event", "is_upper_limit", "multiple_bands_reported")
+_BASE_DEFAULTS = {
+    prop: (False if prop in _BOOLEAN_FLAG_KEYS else None)
+    for prop in JSON_SCHEMA_DICT["properties"]
+}
+
 def get_default_extracted_data(circular_id, circular_url, subject, raw_text):
     """スキーマに基づいてデフォルトの抽出データ構造を返す"""
-    data = {
-        "circular_id": circular_id,
-        "circular_url": circular_url,
-        "subject": subject,
-        "raw_text": raw_text,
-        "extraction_successful": False,
-        "llm_error_message": None,
-        "is_trigger_event": False, # Default
-        "is_upper_limit": False,   # Default
-        "multiple_bands_reported": False # Default
-    }
-    for prop, details in JSON_SCHEMA_DICT["properties"].items():
-        if prop not in data:
-            # Default boolean handling already done for specific fields
-            if details.get("type") == "boolean" and prop in ["is_trigger_event", "is_upper_limit", "multiple_bands_reported"]:
-                continue
-            data[prop] = None
+    data = _BASE_DEFAULTS.copy()
+    data.update(
+        circular_id=circular_id,
+        circular_url=circular_url,
+        subject=subject,
+        raw_text=raw_text,
+        extraction_successful=False,
+        llm_error_message=None
+    )
     return data
 
-def extract_info_with_llm(circular_text, circular_id, circular_url, subject):
-    """LLMを使用してCircularテキストから情報を抽出する"""
-    
-    ordered_keys_for_prompt = [
-        "is_trigger_event", "event_time_utc", "time_since_trigger",
-        "ra", "dec",
-        "magnitude", "magnitude_error", "is_upper_limit", "wavelength_band", "multiple_bands_reported",
-        "telescope", "observatory"
-    ]
-    
+# --- プロンプトの静的部分 (入力に依存しないのでimport時に一度だけ組み立てる) ---
+_ORDERED_KEYS_FOR_PROMPT = [
+    "is_trigger_event", "event_time_utc", "time_since_trigger",
+    "ra", "dec",
+    "magnitude", "magnitude_error", "is_upper_limit", "wavelength_band", "multiple_bands_reported",
+    "telescope", "observatory"
+]
+
+def _build_properties_description():
+    """プロンプト用のフィールド説明を組み立てる"""
     properties_description_list = []
-    for prop in ordered_keys_for_prompt:
+    for prop in _ORDERED_KEYS_FOR_PROMPT:
         details = JSON_SCHEMA_DICT["properties"].get(prop)
         if not details: continue
 
@@ -86,10 +116,12 @@ def extract_info_with_llm(circular_text, circular_id, circular_url, subject):
              additional_info = " (boolean: true or false)"
         
         properties_description_list.append(f"- {prop} ({type_str}{additional_info}): {desc}")
-    properties_description = "\n    ".join(properties_description_list)
+    return "\n    ".join(properties_description_list)
 
+def _build_json_keys_structure():
+    """プロンプト用の出力JSON構造の例を組み立てる"""
     json_keys_structure_lines = []
-    for key in ordered_keys_for_prompt:
+    for key in _ORDERED_KEYS_FOR_PROMPT:
         default_val_str = '"extracted_value_or_null"'
         if key in ["is_trigger_event", "is_upper_limit", "multiple_bands_reported"]:
             default_val_str = 'false' 
@@ -97,9 +129,12 @@ def extract_info_with_llm(circular_text, circular_id, circular_url, subject):
     
     if json_keys_structure_lines:
         json_keys_structure_lines[-1] = json_keys_structure_lines[-1].rstrip(',')
-    json_keys_structure = "{\n" + "\n".join(json_keys_structure_lines) + "\n    }"
+    return "{\n" + "\n".join(json_keys_structure_lines) + "\n    }"
+
+_PROPERTIES_DESCRIPTION = _build_properties_description()
+_JSON_KEYS_STRUCTURE = _build_json_keys_structure()
 
-    prompt = f"""
+_PROMPT_PREFIX = f"""
     You are an expert astronomical data extractor from GCN Circulars.
     Given the GCN Circular text below, extract the specified information and format it as a JSON object.
     Adhere strictly to the following JSON structure. Use `null` for fields if the information is not found or not applicable.
@@ -107,10 +142,10 @@ def extract_info_with_llm(circular_text, circular_id, circular_url, subject):
     Return ONLY the JSON object, with no other text before or after it.
 
     Target JSON structure to populate:
-    {json_keys_structure}
+    {_JSON_KEYS_STRUCTURE}
     
     Field descriptions and extraction guidelines:
-    {properties_description}
+    {_PROPERTIES_DESCRIPTION}
 
     Specific Extraction Rules:
     1.  `is_trigger_event`: Set to `true` if the circular announces the initial discovery or trigger of an event (e.g., "Swift detection of GRB...", "Discovery of a new transient..."). If it's a follow-up observation, an update, or analysis of a previously announced event, set to `false`.
@@ -128,84 +163,266 @@ def extract_info_with_llm(circular_text, circular_id, circular_url, subject):
 
     GCN Circular Text:
     ---
-    {circular_text}
+    """
+_PROMPT_SUFFIX = """
     ---
 
     Extracted JSON Output:
     """
+
+_NUMERIC_KEYS = ("magnitude", "magnitude_error")
+# String fields: lists are joined and numbers (e.g. a Unix time for event_time_utc) become strings
+_TEXT_KEYS = ("event_time_utc", "wavelength_band", "telescope", "observatory")
+# String-or-number fields: lists are joined, numbers are kept
+_VALUE_KEYS = ("time_since_trigger", "ra", "dec", "magnitude", "magnitude_error")
+
+def _normalize_flag(value):
+    """LLMが返したフラグをboolにする (true / "true" 以外はFalse)"""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        return value.strip().lower() == "true"
+    return False
+
+def _normalize_text(value, keep_numbers):
+    """
+    リストは ", " で連結し、keep_numbers=Falseなら数値も文字列にする。
+    真偽値は値なし (None) とし、オブジェクトは "value" キーがあればその値を、なければ文字列表現を使う。
+    """
+    if isinstance(value, bool): # e.g. "ra": false for "not given"
+        return None
+    if isinstance(value, dict): # e.g. {"value": 19.5, "err": 0.1}
+        if "value" in value:
+            return _normalize_text(value["value"], keep_numbers)
+        return str(value)
+    if isinstance(value, list):
+        parts = [_normalize_text(item, keep_numbers=False) for item in value]
+        return ", ".join(part for part in parts if part) or None
+    if value is None or isinstance(value, str):
+        return value
+    if keep_numbers and isinstance(value, (int, float)):
+        return value
+    return str(value)
+
+# Outermost JSON object in the LLM output, ignoring ```json fences or stray text around it
+_JSON_BLOCK_RE = re.compile(r'\{.*\}', re.DOTALL)
+
+class LLMExtraction(msgspec.Struct, kw_only=True):
+    """
+    LLMが返す抽出結果。LLMの出力は型が揺れる (リスト、数値、オブジェクト、"yes" など) ため、
+    フィールドは緩く受け取り、__post_init__ でスキーマの型にそろえる。
+    """
+    is_trigger_event: Any = False
+    event_time_utc: Any = None
+    time_since_trigger: Any = None
+    ra: Any = None
+    dec: Any = None
+    magnitude: Any = None
+    magnitude_error: Any = None
+    is_upper_limit: Any = False
+    wavelength_band: Any = None
+    multiple_bands_reported: Any = False
+    telescope: Any = None
+    observatory: Any = None
+
+    def __post_init__(self):
+        # Only a real true (or the string "true") sets a flag; null and anything unrecognised mean False
+        for bool_key in _BOOLEAN_FLAG_KEYS:
+            setattr(self, bool_key, _normalize_flag(getattr(self, bool_key)))
+        for text_key in _TEXT_KEYS:
+            setattr(self, text_key, _normalize_text(getattr(self, text_key), keep_numbers=False))
+        for value_key in _VALUE_KEYS:
+            setattr(self, value_key, _normalize_text(getattr(self, value_key), keep_numbers=True))
+        # Magnitudes given as numeric strings ("19.5") are stored as numbers; text such as "> 21" is kept as is
+        for numeric_key in _NUMERIC_KEYS:
+            value = getattr(self, numeric_key)
+            if isinstance(value, str):
+                try:
+                    number = float(value)
+                except ValueError:
+                    continue
+                if math.isfinite(number):
+                    setattr(self, numeric_key, number)
+
+def _parse_llm_json_block(llm_output_str):
+    """LLMの出力文字列から最も外側のJSONオブジェクトを取り出し、LLMExtractionとしてデコードする"""
+    match = _JSON_BLOCK_RE.search(llm_output_str)
+    if not match:
+        raise ValueError(f"No JSON object found in LLM output: '{llm_output_str[:200]}'")
+    return msgspec.json.decode(match.group(0), type=LLMExtraction, strict=False)
+
+# --- LLM抽出結果のキャッシュ ---
+LLM_CACHE_FILE = os.path.join(CIRCULAR_TEXT_CACHE_DIR, "llm_extractions.sqlite3")
+
+# The key covers everything that shapes the answer besides the text, so a model or prompt change misses the cache
+_CACHE_KEY_BASE = hashlib.sha256("\0".join((LLM_MODEL, _PROMPT_PREFIX, _PROMPT_SUFFIX, "")).encode('utf-8'))
+# Per-call fields that are filled in from the arguments rather than stored
+_UNCACHED_KEYS = ("circular_id", "circular_url", "subject", "raw_text")
+
+class LLMResultCache:
+    """LLMの抽出結果を本文のSHA256をキーとしてSQLiteに保存する (スレッド間で共有可能)"""
+
+    def __init__(self, path=LLM_CACHE_FILE):
+        self._path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._conn is None:
+            cache_dir = os.path.dirname(self._path)
+            if cache_dir and not os.path.exists(cache_dir):
+                os.makedirs(cache_dir, exist_ok=True)
+            conn = sqlite3.connect(self._path, check_same_thread=False) # Access is serialized by self._lock
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, json BLOB NOT NULL)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def key_for(circular_text):
+        key = _CACHE_KEY_BASE.copy()
+        key.update(circular_text.encode('utf-8'))
+        return key.hexdigest()
+
+    def get(self, key):
+        """キャッシュ済みの抽出結果を返す (無ければNone)"""
+        try:
+            with self._lock:
+                row = self._connection().execute("SELECT json FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            return json_utils.loads(row[0]) if row else None
+        except (sqlite3.Error, json_utils.JSONDecodeError) as e:
+            logger.warning(f"Could not read LLM cache entry {key[:12]} from {self._path}: {e}")
+            return None
+
+    def put(self, key, extracted_data):
+        """抽出結果を保存する (Circular固有のフィールドは除く)"""
+        stored = {k: v for k, v in extracted_data.items() if k not in _UNCACHED_KEYS}
+        try:
+            with self._lock:
+                conn = self._connection()
+                conn.execute("INSERT OR REPLACE INTO llm_cache (key, json) VALUES (?, ?)", (key, json_utils.dumps(stored)))
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Could not write LLM cache entry {key[:12]} to {self._path}: {e}")
+
+_LLM_CACHE = LLMResultCache()
+
+def llm_cache(cache=_LLM_CACHE):
+    """
+    extract_info_with_llm の結果を本文のハッシュでキャッシュするデコレータ。
+    呼び出し時に use_cache=False を渡すとキャッシュを読み書きしない。抽出に成功した結果のみキャッシュする。
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(circular_text, circular_id, circular_url, subject, use_cache=True):
+            if not use_cache or not circular_text:
+                return func(circular_text, circular_id, circular_url, subject)
+            key = cache.key_for(circular_text)
+            cached = cache.get(key)
+            if cached is not None:
+                logger.info(f"Using cached LLM extraction for circular {circular_id}.")
+                extracted_data = get_default_extracted_data(circular_id, circular_url, subject, circular_text)
+                extracted_data.update(cached)
+                return extracted_data
+            extracted_data = func(circular_text, circular_id, circular_url, subject)
+            if extracted_data["extraction_successful"]:
+                cache.put(key, extracted_data)
+            return extracted_data
+        return wrapper
+    return decorator
+
+@llm_cache()
+def extract_info_with_llm(circular_text, circular_id, circular_url, subject):
+    """LLMを使用してCircularテキストから情報を抽出する"""
+
+    # Skip the (slow) LLM call for error pages and other text that cannot be a circular
+    if not looks_like_valid_circular(circular_text):
+        logger.warning(f"Text of circular {circular_id} does not look like a GCN circular. Skipping LLM extraction.")
+        extracted_data = get_default_extracted_data(circular_id, circular_url, subject, circular_text)
+        extracted_data["llm_error_message"] = "Pre-filter: text does not look like a GCN circular"
+        return extracted_data
+    
+    prompt = _PROMPT_PREFIX + circular_text + _PROMPT_SUFFIX
     logger.debug(f"LLM Prompt for circular {circular_id} (first 500 chars): {prompt[:500]}...")
 
     payload = {
         "model": LLM_MODEL,
         "prompt": prompt,
         "stream": False,
-        "format": "json" 
+        "format": "json",
+        "options": LLM_OPTIONS,
+        "keep_alive": LLM_KEEP_ALIVE
     }
 
     extracted_data = get_default_extracted_data(circular_id, circular_url, subject, circular_text)
 
     for attempt in range(MAX_RETRIES_LLM):
         try:
-            response = requests.post(OLLAMA_API_URL, json=payload, timeout=REQUEST_TIMEOUT)
+            response = _SESSION.post(OLLAMA_API_URL, json=payload, timeout=(LLM_CONNECT_TIMEOUT, REQUEST_TIMEOUT))
             response.raise_for_status()
-            api_response_json = response.json()
+            api_response_json = json_utils.loads(response.content) # Single C-level pass over the raw bytes
             parsed_llm_json = None
 
             if "response" in api_response_json and isinstance(api_response_json["response"], str):
-                llm_output_str = api_response_json["response"]
-                try:
-                    parsed_llm_json = json.loads(llm_output_str.strip())
-                except json.JSONDecodeError as e_parse:
-                    logger.warning(f"Initial JSON parse failed for {circular_id}. Response string: '{llm_output_str}'. Error: {e_parse}")
-                    clean_json_str = llm_output_str.strip()
-                    if clean_json_str.startswith("```json"): clean_json_str = clean_json_str[7:]
-                    if clean_json_str.endswith("```"): clean_json_str = clean_json_str[:-3]
-                    parsed_llm_json = json.loads(clean_json_str.strip())
+                parsed_llm_json = _parse_llm_json_block(api_response_json["response"])
             elif isinstance(api_response_json, dict) and "model" in api_response_json:
                 if 'response' in api_response_json and isinstance(api_response_json['response'], (dict, list)):
-                    parsed_llm_json = api_response_json['response']
+                    parsed_llm_json = msgspec.convert(api_response_json['response'], LLMExtraction, strict=False)
                 elif 'response' in api_response_json and isinstance(api_response_json['response'], str):
-                     parsed_llm_json = json.loads(api_response_json['response'])
+                     parsed_llm_json = _parse_llm_json_block(api_response_json['response'])
                 else:
                     temp_json = {k: v for k, v in api_response_json.items() if k not in ['model', 'created_at', 'done', 'total_duration', 'load_duration', 'prompt_eval_count', 'prompt_eval_duration', 'eval_count', 'eval_duration', 'context']}
-                    if temp_json: parsed_llm_json = temp_json
+                    if temp_json: parsed_llm_json = msgspec.convert(temp_json, LLMExtraction, strict=False)
                     else: raise ValueError(f"Unexpected LLM API response (format=json, no clear data) for {circular_id}: {api_response_json}")
             else:
                 raise ValueError(f"Unexpected LLM API response structure for {circular_id}: {api_response_json}")
 
-            for key in JSON_SCHEMA_DICT["properties"].keys():
-                if key in parsed_llm_json and key not in ["circular_id", "circular_url", "subject", "raw_text", "extraction_successful", "llm_error_message"]:
-                    extracted_data[key] = parsed_llm_json[key]
-            
-            # Ensure booleans are booleans
-            for bool_key in ["is_trigger_event", "is_upper_limit", "multiple_bands_reported"]:
-                if isinstance(extracted_data.get(bool_key), str):
-                    extracted_data[bool_key] = extracted_data[bool_key].lower() == "true"
-                elif not isinstance(extracted_data.get(bool_key), bool):
-                    extracted_data[bool_key] = False # Default if type is wrong
-
+            extracted_data.update(msgspec.structs.asdict(parsed_llm_json))
             extracted_data["extraction_successful"] = True
             logger.info(f"Successfully extracted data for circular {circular_id} using LLM.")
             return extracted_data
 
+        # Transient errors (timeouts, connection failures, HTTP 5xx) are retried with backoff.
+        # Everything else is deterministic for the same prompt, so retrying would only waste a generation.
         except requests.exceptions.Timeout:
             logger.error(f"LLM API request timed out for circular {circular_id} (attempt {attempt+1}/{MAX_RETRIES_LLM}).")
             extracted_data["llm_error_message"] = f"API Request Timeout (attempt {attempt+1})"
-        except requests.exceptions.RequestException as e:
-            logger.error(f"LLM API request failed for circular {circular_id} (attempt {attempt+1}/{MAX_RETRIES_LLM}): {e}")
-            extracted_data["llm_error_message"] = f"API Request Error: {e}"
-        except json.JSONDecodeError as e:
+        except requests.exceptions.ConnectionError as e:
+            logger.error(f"LLM API connection failed for circular {circular_id} (attempt {attempt+1}/{MAX_RETRIES_LLM}): {e}")
+            extracted_data["llm_error_message"] = f"API Connection Error: {e}"
+        except requests.exceptions.HTTPError as e:
+            logger.error(f"LLM API returned an error for circular {circular_id} (attempt {attempt+1}/{MAX_RETRIES_LLM}): {e}")
+            extracted_data["llm_error_message"] = f"API HTTP Error: {e}"
+            if e.response is None or e.response.status_code < 500:
+                break
+        except json_utils.JSONDecodeError as e:
             resp_text = response.text if 'response' in locals() and response else 'No response text available'
-            logger.error(f"Failed to parse LLM JSON response for circular {circular_id} (attempt {attempt+1}/{MAX_RETRIES_LLM}): {e}. Response: {resp_text[:500]}")
+            logger.error(f"Failed to parse LLM JSON response for circular {circular_id}: {e}. Response: {resp_text[:500]}")
             extracted_data["llm_error_message"] = f"JSON Decode Error: {e}. Raw LLM output: {resp_text[:200]}"
+            break
+        except msgspec.DecodeError as e:
+            logger.error(f"LLM output for circular {circular_id} does not match the expected schema: {e}")
+            extracted_data["llm_error_message"] = f"LLM Output Validation Error: {e}"
+            break
+        except requests.exceptions.RequestException as e:
+            logger.error(f"LLM API request failed for circular {circular_id}: {e}")
+            extracted_data["llm_error_message"] = f"API Request Error: {e}"
+            break
+        except ValueError as e:
+            logger.error(f"Unexpected LLM output for circular {circular_id}: {e}")
+            extracted_data["llm_error_message"] = f"Invalid LLM Output: {e}"
+            break
         except Exception as e:
-            logger.error(f"An unexpected error occurred during LLM extraction for {circular_id} (attempt {attempt+1}/{MAX_RETRIES_LLM}): {e}", exc_info=True)
+            logger.error(f"An unexpected error occurred during LLM extraction for {circular_id}: {e}", exc_info=True)
             extracted_data["llm_error_message"] = f"Unexpected Error: {str(e)}"
+            break
         
         if attempt < MAX_RETRIES_LLM - 1:
-            sleep_time = 5 * (attempt + 1)
-            logger.info(f"Retrying in {sleep_time} seconds...")
+            sleep_time = min(LLM_MAX_BACKOFF_SECONDS, 2 ** attempt) + random.uniform(0, 1)
+            logger.info(f"Retrying in {sleep_time:.1f} seconds...")
             time.sleep(sleep_time)
             
-    logger.error(f"All LLM extraction attempts failed for circular {circular_id}.")
+    logger.error(f"LLM extraction failed for circular {circular_id}.")
     return extracted_data
\ No newline at end of file
@@ -1,17 +1,20 @@
 # main.py
 import time
+import asyncio
 import logging
 import sys
 import os
+import signal
 
 from config import (
-    CHECK_INTERVAL_SECONDS, GCN_CIRCULARS_INDEX_URL,
+    GCN_CIRCULARS_INDEX_URL,
     LOG_FILE, LOG_LEVEL, SKIP_CIRCULARS_BEFORE_ID
 )
-from gcn_utils import get_page_content, parse_gcn_circular_list, get_circular_text_robust
+from gcn_utils_async import create_client_session, iter_gcn_circular_list_async, get_circular_text_robust_async
 from llm_utils import extract_info_with_llm, get_default_extracted_data
-from data_manager import load_processed_ids, save_processed_id, load_output_data, save_output_data
-from slack_notifier import send_slack_notification
+from data_manager import ProcessedIdStore, JsonArrayMaterializer, migrate_legacy_output, append_output_record
+from slack_notifier import SlackBatcher
+from poll_scheduler import PollScheduler
 
 
 # --- ロギング設定 ---
@@ -22,7 +25,7 @@ if LOG_FILE:
         try:
             os.makedirs(log_dir, exist_ok=True) # exist_ok=Trueでディレクトリが既に存在してもエラーにしない
             logger_init = logging.getLogger(__name__) # Use a temporary logger for this message
-            logger_init.info(f"Created log directory: {log_dir}")
+            logger_init.info("Created log directory: %s", log_dir)
         except OSError as e:
             # Use a temporary logger or print for this critical init error
             print(f"CRITICAL: Could not create log directory {log_dir}: {e}. File logging will be disabled.")
@@ -37,132 +40,183 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-
-def process_single_circular(circ_info, all_extracted_data_list_ref): # Pass list by ref for modification
-    """単一のCircularを処理し、結果をall_extracted_data_list_refに追加する"""
+PROCESSING_CONCURRENCY = 8 # Max circulars in flight within a cycle; also how far text fetching runs ahead of the LLM
+LLM_CONCURRENCY = 1 # Ollama generates one response at a time by default; more requests would only queue (and time out) there
+INDEX_EARLY_EXIT_MARGIN = 50 # Rows this far below the highest processed ID are assumed processed; reading stops there
+
+async def collect_index_circulars(http_session, stop_below_id=None):
+    """
+    Circular一覧をストリーミングで読み、IDがstop_below_id未満の行に達した時点で読み込みを打ち切る。
+    一覧は新しい順に並んでいる前提だが、先頭がすでに閾値未満の場合 (並び順が想定と違う場合) は最後まで読む。
+    """
+    circulars = []
+    seen_recent = False
+    index_iter = iter_gcn_circular_list_async(http_session, GCN_CIRCULARS_INDEX_URL)
+    try:
+        async for circ_info in index_iter:
+            if stop_below_id is not None and circ_info['id'].isdigit():
+                if int(circ_info['id']) >= stop_below_id:
+                    seen_recent = True
+                elif seen_recent:
+                    logger.debug("Stopped reading the index at circular %s (below %s).", circ_info['id'], stop_below_id)
+                    break
+            circulars.append(circ_info)
+    finally:
+        await index_iter.aclose() # Releases the streamed response right away instead of at garbage collection
+    return circulars
+
+async def process_single_circular(http_session, circ_info, processed_ids, slack_batcher, llm_semaphore, json_array):
+    """単一のCircularの本文を取得・処理し、結果を出力ファイルに追記してSlack通知を登録する"""
     circular_id = circ_info['id']
     circular_url = circ_info['url']
     subject = circ_info.get('subject', f"Subject for {circular_id}")
 
-    logger.info(f"Processing new circular: ID {circular_id}, URL: {circular_url}")
+    logger.info("Processing new circular: ID %s, URL: %s", circular_id, circular_url)
 
-    raw_text = get_circular_text_robust(circular_id, circular_url)
+    raw_text = await get_circular_text_robust_async(http_session, circular_id, circular_url)
 
     if not raw_text:
-        logger.warning(f"Could not retrieve raw text for circular {circular_id}. Skipping LLM extraction.")
+        logger.warning("Could not retrieve raw text for circular %s. Skipping LLM extraction.", circular_id)
         error_entry = get_default_extracted_data(circular_id, circular_url, subject, "COULD NOT RETRIEVE TEXT")
         error_entry["extraction_successful"] = False
         error_entry["llm_error_message"] = "Failed to retrieve raw text from circular page or .gcn3 file."
-        all_extracted_data_list_ref.append(error_entry)
-        send_slack_notification(error_entry)
-        return # No need to return error_entry, it's added to the list
-
-    extracted_json = extract_info_with_llm(raw_text, circular_id, circular_url, subject)
-    all_extracted_data_list_ref.append(extracted_json)
+        append_output_record(error_entry)
+        json_array.mark_dirty()
+        slack_batcher.add(error_entry)
+        processed_ids.add(circular_id)
+        return
+
+    # The LLM client is synchronous; run it in a worker thread so the texts of the next circulars are fetched meanwhile
+    async with llm_semaphore:
+        extracted_json = await asyncio.to_thread(extract_info_with_llm, raw_text, circular_id, circular_url, subject)
+    append_output_record(extracted_json)
+    json_array.mark_dirty() # Counted per record so an exit mid-cycle still writes the JSON array
 
     if extracted_json["extraction_successful"]:
-        logger.info(f"Successfully processed circular {circular_id}.")
+        logger.info("Successfully processed circular %s.", circular_id)
     else:
-        logger.warning(f"Failed to fully process circular {circular_id}. LLM Error: {extracted_json.get('llm_error_message')}")
+        logger.warning("Failed to fully process circular %s. LLM Error: %s", circular_id, extracted_json.get('llm_error_message'))
     
-    send_slack_notification(extracted_json)
-    # No need to return extracted_json, it's added to the list
+    slack_batcher.add(extracted_json)
+    processed_ids.add(circular_id)
+    if slack_batcher.is_due(): # Don't hold notifications back for the whole cycle during a long backfill
+        await slack_batcher.flush_async(http_session)
 
-def main_loop():
+async def main_loop():
     logger.info("Starting GCN Circular monitoring service...")
     
     skip_before_id_val = None
     if SKIP_CIRCULARS_BEFORE_ID is not None:
         try:
             skip_before_id_val = int(SKIP_CIRCULARS_BEFORE_ID)
-            logger.info(f"Will skip circulars with ID less than {skip_before_id_val}.")
+            logger.info("Will skip circulars with ID less than %s.", skip_before_id_val)
         except ValueError:
-            logger.error(f"Invalid format for SKIP_CIRCULARS_BEFORE_ID: '{SKIP_CIRCULARS_BEFORE_ID}'. It should be an integer. Filtering by ID will be disabled.")
+            logger.error("Invalid format for SKIP_CIRCULARS_BEFORE_ID: '%s'. It should be an integer. Filtering by ID will be disabled.", SKIP_CIRCULARS_BEFORE_ID)
             skip_before_id_val = None
 
-    processed_ids = load_processed_ids()
-    all_extracted_data = load_output_data() # This is now a list
-    
-    for item in all_extracted_data:
-        if 'circular_id' in item and item['circular_id'] is not None:
-            processed_ids.add(str(item['circular_id']))
-    logger.info(f"Loaded {len(processed_ids)} processed IDs and {len(all_extracted_data)} existing data entries.")
-
-    while True:
-        current_utc_time_str = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
-        logger.info(f"Checking for new GCN circulars... (Last check: {current_utc_time_str})")
-        
-        index_html = get_page_content(GCN_CIRCULARS_INDEX_URL)
-        if not index_html:
-            logger.error("Failed to fetch GCN circulars list. Retrying later.")
-            time.sleep(CHECK_INTERVAL_SECONDS)
-            continue
-
-        circulars_on_page = parse_gcn_circular_list(index_html)
-        if not circulars_on_page:
-            logger.info("No circulars found on the main page or parsing failed.")
-            time.sleep(CHECK_INTERVAL_SECONDS)
-            continue
-        
-        new_circulars_processed_this_cycle = 0 # Renamed for clarity
-        skipped_due_to_id_count = 0
-        
-        # Sort by ID ascending to process oldest new ones first
-        # GCN list is usually newest first, so reversed() makes it oldest first.
-        # If parse_gcn_circular_list already sorts them, this might be redundant or reversed.
-        # Assuming parse_gcn_circular_list returns them as they appear on page (newest first).
-        for circ_info in reversed(circulars_on_page): 
-            circular_id_str = circ_info['id'] 
+    migrate_legacy_output()
+    # The processed-IDs file is the sidecar index of the output; the extracted data itself is not read at startup
+    processed_ids = ProcessedIdStore() # Appends are buffered and flushed in batches
+    logger.info("Loaded %d processed IDs.", len(processed_ids))
+
+    json_array = JsonArrayMaterializer() # Rewrites the JSON array file every JSON_ARRAY_REWRITE_EVERY records or 10 minutes
+
+    poll_scheduler = PollScheduler() # Adapts the wait between index checks to the observed arrival pattern
+
+    slack_batcher = SlackBatcher() # Notifications of a cycle go out as one message
+
+    # Circulars whose processing raised are not marked processed; the index is read at least down to them until they succeed
+    failed_ids = set()
+    # The first cycle reads the whole index so that failures from before a restart are picked up too
+    read_full_index = True
+
+    # One HTTP session (and connection pool) for GCN and Slack, kept alive across cycles
+    async with create_client_session() as http_session:
+        while True:
+            cycle_started_at = time.monotonic() # The interval is measured from the start of the cycle, not the end of its work
+            current_utc_time_str = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+            logger.info("Checking for new GCN circulars... (Last check: %s)", current_utc_time_str)
             
-            try:
-                current_circular_id_int = int(circular_id_str)
-            except ValueError:
-                logger.warning(f"Circular ID '{circular_id_str}' is not a valid integer. Skipping this entry.")
-                # Optionally, save this malformed ID as processed to avoid re-evaluating
-                if circular_id_str not in processed_ids:
-                    save_processed_id(circular_id_str)
-                    processed_ids.add(circular_id_str)
+            # The index page is parsed while it streams in and abandoned once it reaches already-processed IDs
+            failed_ids = {circular_id_str for circular_id_str in failed_ids if circular_id_str not in processed_ids}
+            max_processed_id = processed_ids.max_numeric_id
+            stop_below_id = None
+            if not read_full_index and max_processed_id is not None:
+                stop_below_id = min([max_processed_id - INDEX_EARLY_EXIT_MARGIN, *(int(circular_id_str) for circular_id_str in failed_ids)])
+            circulars_on_page = await collect_index_circulars(http_session, stop_below_id)
+            if not circulars_on_page:
+                logger.info("No circulars found on the main page, or fetching/parsing failed. Retrying later.")
+                await asyncio.sleep(max(0.0, cycle_started_at + poll_scheduler.next_interval() - time.monotonic()))
                 continue
+            read_full_index = False
+            
+            # Only the IDs not processed yet are looked at, oldest (smallest ID) first
+            circulars_by_id = {circ_info['id']: circ_info for circ_info in circulars_on_page}
+            unprocessed_ids = [circular_id_str for circular_id_str in circulars_by_id if circular_id_str not in processed_ids]
+
+            malformed_ids = [circular_id_str for circular_id_str in unprocessed_ids if not circular_id_str.isdecimal()]
+            for circular_id_str in malformed_ids:
+                logger.warning("Circular ID '%s' is not a valid integer. Skipping this entry.", circular_id_str)
+            # Save malformed IDs as processed to avoid re-evaluating them every cycle
+            processed_ids.update(malformed_ids)
 
+            new_ids = sorted((circular_id_str for circular_id_str in unprocessed_ids if circular_id_str.isdecimal()), key=int)
+
+            skipped_ids = []
             if skip_before_id_val is not None:
-                if current_circular_id_int < skip_before_id_val:
-                    if circular_id_str not in processed_ids: 
-                        logger.info(f"Skipping circular {circular_id_str} as its ID ({current_circular_id_int}) is less than {skip_before_id_val}.")
-                        save_processed_id(circular_id_str)
-                        processed_ids.add(circular_id_str)
-                        skipped_due_to_id_count +=1
-                    continue 
-
-            if circular_id_str in processed_ids:
-                continue
-            
-            new_circulars_processed_this_cycle += 1
-            process_single_circular(circ_info, all_extracted_data) # Modifies all_extracted_data directly
-            
-            save_processed_id(circular_id_str) 
-            processed_ids.add(circular_id_str)
+                # new_ids is sorted, so the skipped IDs are a prefix of it
+                skipped_ids = [circular_id_str for circular_id_str in new_ids if int(circular_id_str) < skip_before_id_val]
+                for circular_id_str in skipped_ids:
+                    logger.info("Skipping circular %s as its ID is less than %s.", circular_id_str, skip_before_id_val)
+                processed_ids.update(skipped_ids)
+                new_ids = new_ids[len(skipped_ids):]
+            skipped_due_to_id_count = len(skipped_ids)
+
+            new_circulars = [circulars_by_id[circular_id_str] for circular_id_str in new_ids]
+
+            # Process the new circulars as a pipeline: up to PROCESSING_CONCURRENCY texts are fetched ahead
+            # while the LLM, the slowest stage, works through them LLM_CONCURRENCY at a time
+            semaphore = asyncio.Semaphore(PROCESSING_CONCURRENCY)
+            llm_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+
+            async def process_bounded(circ_info):
+                async with semaphore:
+                    await process_single_circular(http_session, circ_info, processed_ids, slack_batcher, llm_semaphore, json_array)
+
+            results = await asyncio.gather(*(process_bounded(circ_info) for circ_info in new_circulars), return_exceptions=True)
+            for circ_info, result in zip(new_circulars, results):
+                if isinstance(result, Exception):
+                    logger.error("Unexpected error while processing circular %s: %s", circ_info['id'], result, exc_info=result)
+                    failed_ids.add(circ_info['id']) # Retried next cycle even if it falls below the early-exit margin
+
+            await slack_batcher.flush_async(http_session)
+            new_circulars_processed_this_cycle = len(new_circulars)
+
+            processed_ids.flush() # Persist this cycle's IDs before sleeping
 
-            if new_circulars_processed_this_cycle > 0 : # Only sleep if we actually processed something
-                 time.sleep(max(1, CHECK_INTERVAL_SECONDS // 1800)) # Sleep a little, e.g. 2s if interval is 1hr
+            if skipped_due_to_id_count > 0:
+                logger.info("Skipped %d circular(s) due to ID filter in this cycle.", skipped_due_to_id_count)
 
-        if skipped_due_to_id_count > 0:
-            logger.info(f"Skipped {skipped_due_to_id_count} circular(s) due to ID filter in this cycle.")
+            if new_circulars_processed_this_cycle > 0:
+                logger.info("Processed %d new circular(s) in this cycle.", new_circulars_processed_this_cycle)
+            else:
+                if skipped_due_to_id_count == 0: # Only log "no new" if no ID skips happened either
+                    logger.info("No new circulars to process in this cycle.")
 
-        if new_circulars_processed_this_cycle > 0:
-            logger.info(f"Processed {new_circulars_processed_this_cycle} new circular(s) in this cycle. Saving all data.")
-            save_output_data(all_extracted_data) # Save the updated list
-        else:
-            if skipped_due_to_id_count == 0: # Only log "no new" if no ID skips happened either
-                logger.info("No new circulars to process in this cycle.")
+            json_array.maybe_materialize() # Also runs on quiet cycles so the time threshold is honoured
 
-        logger.info(f"Next check in {CHECK_INTERVAL_SECONDS // 60} minutes ({CHECK_INTERVAL_SECONDS} seconds).")
-        time.sleep(CHECK_INTERVAL_SECONDS)
+            next_interval = poll_scheduler.record_cycle(new_circulars_processed_this_cycle)
+            sleep_seconds = max(0.0, cycle_started_at + next_interval - time.monotonic())
+            logger.info("Next check in %.1f minutes (%.0f seconds; interval %.0f seconds).", sleep_seconds / 60, sleep_seconds, next_interval)
+            await asyncio.sleep(sleep_seconds)
 
 if __name__ == "__main__":
+    # Turn SIGTERM into SystemExit so atexit handlers (e.g. processed ID flush) still run
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     try:
-        main_loop()
+        asyncio.run(main_loop())
     except KeyboardInterrupt:
         logger.info("GCN Monitor stopped by user.")
     except Exception as e:
-        logger.critical(f"Critical error in main loop: {e}", exc_info=True)
+        logger.critical("Critical error in main loop: %s", e, exc_info=True)
         sys.exit(1)
\ No newline at end of file
@@ -0,0 +1,101 @@
+# poll_scheduler.py
+import os
+import time
+import bisect
+import logging
+from collections import deque
+from itertools import islice
+import json_utils
+from config import CHECK_INTERVAL_SECONDS, PROCESSED_CIRCULARS_FILE
+
+logger = logging.getLogger(__name__)
+
+# 新着を検出した時刻 (UNIX時刻) の履歴は処理済みIDファイルと同じ場所に保存する
+ARRIVALS_FILE = os.path.splitext(PROCESSED_CIRCULARS_FILE)[0] + "_arrivals.json"
+
+ARRIVAL_HISTORY_SIZE = 256 # Ring buffer length of remembered arrival times
+MIN_ARRIVAL_SAMPLES = 10 # Fewer inter-arrival gaps than this: the histogram is too sparse to schedule from
+MIN_POLL_INTERVAL_SECONDS = max(15, CHECK_INTERVAL_SECONDS // 4)
+MAX_POLL_INTERVAL_SECONDS = CHECK_INTERVAL_SECONDS * 4
+HISTOGRAM_BIN_SECONDS = MIN_POLL_INTERVAL_SECONDS
+MAX_SCHEDULE_STEPS = 1000 # Bounds the recurrence when the last arrival is far in the past
+
+class PollScheduler:
+    """
+    新着Circularの到着間隔の経験分布から次回のポーリングまでの待ち時間を決める。
+    到着間隔のヒストグラム p(t) に対して L_{i+1} = L_i + (F(L_i) - F(L_{i-1})) / p(L_i) でポーリング時刻を並べ、
+    新着のないサイクルが続いた場合は待ち時間を倍々に伸ばし (新着があれば基準値に戻す)、
+    最後の到着から観測済みの最大の到着間隔を超えて経過した後は、その待ち時間をスケジュールより優先する。
+    """
+
+    def __init__(self, base_interval=CHECK_INTERVAL_SECONDS, path=ARRIVALS_FILE):
+        self._base_interval = base_interval
+        self._path = path
+        self._arrivals = deque(self._load(), maxlen=ARRIVAL_HISTORY_SIZE)
+        self._backoff_interval = base_interval
+
+    def _load(self):
+        if not os.path.exists(self._path):
+            return []
+        try:
+            with open(self._path, 'rb') as f:
+                return [float(t) for t in json_utils.loads(f.read())]
+        except Exception as e:
+            logger.warning(f"Could not load arrival history from {self._path}: {e}. Starting with an empty history.")
+            return []
+
+    def _save(self):
+        temp_file = self._path + ".tmp"
+        try:
+            arrivals_dir = os.path.dirname(self._path)
+            if arrivals_dir and not os.path.exists(arrivals_dir):
+                os.makedirs(arrivals_dir, exist_ok=True)
+            with open(temp_file, 'wb') as f:
+                f.write(json_utils.dumps(list(self._arrivals)))
+            os.replace(temp_file, self._path)
+        except Exception as e:
+            logger.error(f"Error saving arrival history to {self._path}: {e}")
+
+    def record_cycle(self, new_count, now=None):
+        """1回のポーリング結果 (新着件数) を記録し、次回までの待ち時間 (秒) を返す"""
+        now = time.time() if now is None else now
+        if new_count > 0:
+            self._arrivals.append(now)
+            self._save()
+            self._backoff_interval = self._base_interval
+        else:
+            self._backoff_interval = min(2 * self._backoff_interval, MAX_POLL_INTERVAL_SECONDS)
+        return self.next_interval(now)
+
+    def next_interval(self, now=None):
+        """次回のポーリングまでの待ち時間 (秒) を返す"""
+        if len(self._arrivals) <= MIN_ARRIVAL_SAMPLES:
+            return self._backoff_interval
+        now = time.time() if now is None else now
+        elapsed = now - self._arrivals[-1]
+        gaps = sorted(later - earlier for earlier, later in zip(self._arrivals, islice(self._arrivals, 1, None)))
+        scheduled = self._scheduled_delay(elapsed, gaps)
+        if elapsed > gaps[-1]:
+            # Past every observed gap the histogram has no mass left to schedule from; let the quiet-cycle backoff raise the wait
+            return max(MIN_POLL_INTERVAL_SECONDS, min(max(scheduled, self._backoff_interval), MAX_POLL_INTERVAL_SECONDS))
+        return max(MIN_POLL_INTERVAL_SECONDS, min(scheduled, self._backoff_interval))
+
+    def _scheduled_delay(self, elapsed, gaps):
+        """最後の到着から elapsed 秒経過した時点で、次のポーリング時刻までの秒数を返す (gapsは昇順の到着間隔)"""
+        n = len(gaps)
+
+        def cdf(t):
+            return bisect.bisect_right(gaps, t) / n
+
+        def pdf(t):
+            bin_start = (t // HISTOGRAM_BIN_SECONDS) * HISTOGRAM_BIN_SECONDS
+            return (cdf(bin_start + HISTOGRAM_BIN_SECONDS) - cdf(bin_start)) / HISTOGRAM_BIN_SECONDS
+
+        previous, current = 0.0, float(self._base_interval)
+        for _ in range(MAX_SCHEDULE_STEPS):
+            if current > elapsed:
+                return current - elapsed
+            density = pdf(current)
+            step = (cdf(current) - cdf(previous)) / density if density > 0 else MAX_POLL_INTERVAL_SECONDS
+            previous, current = current, current + min(max(step, MIN_POLL_INTERVAL_SECONDS), MAX_POLL_INTERVAL_SECONDS)
+        return MAX_POLL_INTERVAL_SECONDS
@@ -1,139 +1,310 @@
 # slack_notifier.py
+import asyncio
+import gzip
+import time
 import requests
+import aiohttp
 import json
 import logging
+import json_utils
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+import config
 from config import SLACK_WEBHOOK_URL, SLACK_CHANNEL, SLACK_USERNAME, SLACK_ICON_EMOJI
 
 logger = logging.getLogger(__name__)
 
+# Checked before any formatting work, so a disabled Slack costs nothing per circular
+_SLACK_ENABLED = bool(SLACK_WEBHOOK_URL)
+
+# --- HTTPセッション (Slack Webhookへの接続を再利用する) ---
+SLACK_MAX_RETRIES = 3
+SLACK_RETRY_BACKOFF_FACTOR = 0.3 # Sleep backoff_factor * 2**attempt seconds between attempts
+SLACK_RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+SLACK_MAX_RETRY_AFTER_SECONDS = 60 # Cap on a Retry-After header so one message cannot stall the loop
+
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=4,
+    # POST is not retried by default; a webhook call that got 429/5xx was not delivered
+    max_retries=Retry(total=SLACK_MAX_RETRIES, backoff_factor=SLACK_RETRY_BACKOFF_FACTOR, status_forcelist=SLACK_RETRY_STATUSES, allowed_methods=frozenset(['POST']))
+))
+
+_JSON_HEADERS = {'Content-Type': 'application/json'} # Bodies are sent as the UTF-8 bytes from json_utils.dumps
+_GZIP_JSON_HEADERS = {**_JSON_HEADERS, 'Content-Encoding': 'gzip'}
+# Off unless config.SLACK_GZIP_REQUESTS is set: incoming webhooks do not document support for gzip-encoded request bodies
+SLACK_GZIP_REQUESTS = getattr(config, "SLACK_GZIP_REQUESTS", False)
+SLACK_GZIP_MIN_BYTES = 1024 # With gzip enabled, bodies larger than this are compressed (batched block-kit payloads reach tens of KB)
+
+# --- 通知のバッチ送信の設定 ---
+SLACK_BATCH_MAX_SIZE = 20 # Circulars per batched message
+SLACK_BATCH_INTERVAL_SECONDS = 10 # A pending batch older than this is sent without waiting for the cycle to end
+SLACK_MAX_BLOCKS = 50 # Slack rejects messages with more blocks than this
+
+_DIVIDER_BLOCK = {"type": "divider"} # Only ever serialized, so one instance is shared
+_MRKDWN = {"type": "mrkdwn"} # Template for mrkdwn text objects: {**_MRKDWN, "text": ...}
+
+def _format_number(value, spec=".2f"):
+    """数値はspecで整形し、それ以外 (文字列で返された値) はそのまま表示する"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return format(value, spec)
+    return str(value)
+
 def format_slack_message(data):
     """抽出されたデータをSlackメッセージ用に整形する"""
+    circular_id = data['circular_id']
+    circular_url = data['circular_url']
+
     if not data.get("extraction_successful"):
-        # ... (エラーメッセージ部分は変更なし) ...
-        message = f"⚠️ Failed to extract data for GCN Circular <{data['circular_url']}|*{data['circular_id']}*>"
-        if data.get("subject"):
-            message += f"\n*Subject*: {data['subject']}"
-        if data.get("llm_error_message"):
-            message += f"\n*Error*: `{data['llm_error_message']}`"
+        message = f"⚠️ Failed to extract data for GCN Circular <{circular_url}|*{circular_id}*>"
+        subject = data.get("subject")
+        if subject:
+            message += f"\n*Subject*: {subject}"
+        llm_error_message = data.get("llm_error_message")
+        if llm_error_message:
+            message += f"\n*Error*: `{llm_error_message}`"
         return {
             "text": message,
-            "blocks": [{"type": "section", "text": {"type": "mrkdwn", "text": message}}]
+            "blocks": [{"type": "section", "text": {**_MRKDWN, "text": message}}]
         }
 
+    # Every field is looked up once here
     subject = data.get("subject", "N/A")
+    is_trigger = data.get("is_trigger_event")
+    telescope = data.get("telescope")
+    observatory = data.get("observatory")
+    ra = data.get("ra")
+    dec = data.get("dec")
+    magnitude = data.get("magnitude")
+    magnitude_error = data.get("magnitude_error")
+    wavelength_band = data.get("wavelength_band")
+    event_time_utc = data.get("event_time_utc")
+    time_since_trigger = data.get("time_since_trigger")
     
     # ヘッダー構築
-    header_icon = "🚨" if data.get("is_trigger_event") else "🛰️"
-    header_text_parts = [f"{header_icon} GCN Circular {data['circular_id']}"]
-    if data.get("is_trigger_event"):
-        header_text_parts.append("- *TRIGGER EVENT*")
+    header_icon = "🚨" if is_trigger else "🛰️"
+    header_text_parts = [header_icon, " GCN Circular ", str(circular_id)]
+    if is_trigger:
+        header_text_parts.append(" - *TRIGGER EVENT*")
     
     tel_obs_parts = []
-    if data.get("telescope"):
-        tel_obs_parts.append(data['telescope'])
-    if data.get("observatory") and data.get("observatory") != data.get("telescope"):
-        tel_obs_parts.append(f"at {data['observatory']}")
+    if telescope:
+        tel_obs_parts.append(telescope)
+    if observatory and observatory != telescope:
+        tel_obs_parts.append(f"at {observatory}")
     if tel_obs_parts:
-        header_text_parts.append(f"({', '.join(tel_obs_parts)})")
-    header_text = " ".join(header_text_parts)
+        header_text_parts += (" (", ", ".join(tel_obs_parts), ")")
+    header_text = "".join(header_text_parts)
 
-    title_block_text = f"*Subject*: {subject}\n*<{data['circular_url']}|View Circular on GCN>*"
+    title_block_text = f"*Subject*: {subject}\n*<{circular_url}|View Circular on GCN>*"
 
-    fields = []
+    # Each field is rendered straight to its "*Title*:\nvalue" mrkdwn text
+    mrkdwn_fields_elements = []
     
     # Coordinates
-    if data.get("ra") and data.get("dec"):
-        fields.append({"title": "RA / Dec", "value": f"`{data['ra']}` / `{data['dec']}`", "short": True})
-    elif not data.get("is_trigger_event"): # トリガーでなく座標もない場合
-        fields.append({"title": "Coordinates", "value": "_Not provided in this circular_", "short": True})
+    if ra and dec:
+        mrkdwn_fields_elements.append(f"*RA / Dec*:\n`{ra}` / `{dec}`")
+    elif not is_trigger: # トリガーでなく座標もない場合
+        mrkdwn_fields_elements.append("*Coordinates*:\n_Not provided in this circular_")
 
     # Magnitude block
-    mag_str_parts = []
-    mag_title = "Magnitude"
-    if data.get("magnitude") is not None:
-        mag_val = str(data['magnitude'])
+    if magnitude is not None:
+        mag_str = _format_number(magnitude)
         if data.get("is_upper_limit"):
-            mag_str_parts.append(f"> {mag_val} (UL)")
-        else:
-            mag_str_parts.append(mag_val)
-        
-        if data.get("magnitude_error") is not None:
-            mag_str_parts.append(f"± {data['magnitude_error']}")
-        
-        if data.get("wavelength_band"):
-            mag_str_parts.append(f"[{data['wavelength_band']}]")
+            mag_str = f"> {mag_str} (UL)"
+        error_str = f" ± {_format_number(magnitude_error, '.2g')}" if magnitude_error is not None else "" # Two significant figures: .2f would show an error of 0.004 as 0.00
+        band_str = f" [{wavelength_band}]" if wavelength_band else ""
+        mag_display_str = f"{mag_str}{error_str}{band_str}"
 
-        mag_display_str = " ".join(mag_str_parts)
+        mag_title = "Magnitude"
         if data.get("multiple_bands_reported"):
             mag_title = "Brightest Mag." # 複数バンド報告時は明示
             mag_display_str += " (multi-band)"
 
-        fields.append({"title": mag_title, "value": f"`{mag_display_str}`", "short": True})
-    elif data.get("wavelength_band"): # 等級なしでもバンド情報があれば表示
-         fields.append({"title": "Band Obs.", "value": data['wavelength_band'], "short": True})
-
+        mrkdwn_fields_elements.append(f"*{mag_title}*:\n`{mag_display_str}`")
+    elif wavelength_band: # 等級なしでもバンド情報があれば表示
+        mrkdwn_fields_elements.append(f"*Band Obs.*:\n{wavelength_band}")
 
     # Time information
-    if data.get("is_trigger_event"):
-        if data.get("event_time_utc"):
-            fields.append({"title": "Trigger Time (UTC)", "value": f"`{data['event_time_utc']}`", "short": True})
+    if is_trigger:
+        if event_time_utc:
+            mrkdwn_fields_elements.append(f"*Trigger Time (UTC)*:\n`{event_time_utc}`")
     else: # Follow-up
-        if data.get("event_time_utc"):
-            fields.append({"title": "Obs. Time (UTC)", "value": f"`{data['event_time_utc']}`", "short": True})
-        if data.get("time_since_trigger"):
-            fields.append({"title": "Time Since Trig.", "value": data['time_since_trigger'], "short": True})
-    
-    # Other info (Telescope/Observatory already in header, Wavelength_band with magnitude)
-    # if data.get("wavelength_band") and data.get("magnitude") is None: # Only if not with mag
-    #    fields.append({"title": "Band", "value": data['wavelength_band'], "short": True})
-
-
-    mrkdwn_fields_elements = []
-    for field in fields:
-        mrkdwn_fields_elements.append(f"*{field['title']}*:\n{field['value']}")
+        if event_time_utc:
+            mrkdwn_fields_elements.append(f"*Obs. Time (UTC)*:\n`{event_time_utc}`")
+        if time_since_trigger:
+            mrkdwn_fields_elements.append(f"*Time Since Trig.*:\n{time_since_trigger}")
 
     blocks = [
         {"type": "header", "text": {"type": "plain_text", "text": header_text, "emoji": True}},
-        {"type": "section", "text": {"type": "mrkdwn", "text": title_block_text}}
+        {"type": "section", "text": {**_MRKDWN, "text": title_block_text}}
     ]
 
     if mrkdwn_fields_elements:
-        blocks.append({"type": "divider"})
-        field_sections = []
-        for i in range(0, len(mrkdwn_fields_elements), 2):
-            current_pair = [{"type": "mrkdwn", "text": mrkdwn_fields_elements[i]}]
-            if i + 1 < len(mrkdwn_fields_elements):
-                current_pair.append({"type": "mrkdwn", "text": mrkdwn_fields_elements[i+1]})
-            field_sections.append({"type": "section", "fields": current_pair})
-        blocks.extend(field_sections)
+        blocks.append(_DIVIDER_BLOCK)
+        # zip() over one iterator pairs consecutive fields; an odd last field gets a section of its own
+        field_iter = iter(mrkdwn_fields_elements)
+        blocks.extend(
+            {"type": "section", "fields": [{**_MRKDWN, "text": left}, {**_MRKDWN, "text": right}]}
+            for left, right in zip(field_iter, field_iter)
+        )
+        if len(mrkdwn_fields_elements) % 2:
+            blocks.append({"type": "section", "fields": [{**_MRKDWN, "text": mrkdwn_fields_elements[-1]}]})
 
     payload = {
         "username": SLACK_USERNAME,
         "icon_emoji": SLACK_ICON_EMOJI,
         "blocks": blocks,
-        "text": f"{header_icon} GCN {data['circular_id']}: {subject}" # Fallback
+        "text": f"{header_icon} GCN {circular_id}: {subject}" # Fallback
     }
     if SLACK_CHANNEL:
         payload["channel"] = SLACK_CHANNEL
         
     return payload
 
-# send_slack_notification 関数は変更なし
-def send_slack_notification(data):
-    if not SLACK_WEBHOOK_URL:
-        logger.debug("SLACK_WEBHOOK_URL not set. Skipping notification.")
-        return False
-    payload = format_slack_message(data)
-    logger.debug(f"Slack payload: {json.dumps(payload, indent=2)}")
+def _encode_body(payload):
+    """ペイロードを (リクエストボディ, ヘッダー) に変換する。gzipが有効なら大きなボディは圧縮する"""
+    body = json_utils.dumps(payload)
+    if SLACK_GZIP_REQUESTS and len(body) > SLACK_GZIP_MIN_BYTES:
+        # Level 1: most of the size reduction on repetitive JSON at a fraction of the CPU cost of the default 9
+        return gzip.compress(body, compresslevel=1), _GZIP_JSON_HEADERS
+    return body, _JSON_HEADERS
+
+def _post_payload(payload, description):
+    """整形済みのペイロードをSlack Webhookに送信する"""
+    if logger.isEnabledFor(logging.DEBUG): # Skip serializing the payload just for a discarded log line
+        logger.debug("Slack payload: %s", json.dumps(payload))
     try:
-        response = requests.post(SLACK_WEBHOOK_URL, data=json.dumps(payload), headers={'Content-Type': 'application/json'}, timeout=30)
+        body, headers = _encode_body(payload)
+        response = _SESSION.post(SLACK_WEBHOOK_URL, data=body, headers=headers, timeout=30)
         response.raise_for_status()
         if response.text != "ok":
-             logger.warning(f"Slack notification sent for circular {data.get('circular_id')}, but response was not 'ok': {response.text}")
+             logger.warning("Slack notification sent for %s, but response was not 'ok': %s", description, response.text)
         else:
-            logger.info(f"Slack notification sent successfully for circular {data.get('circular_id')}")
+            logger.info("Slack notification sent successfully for %s", description)
         return True
     except requests.exceptions.RequestException as e:
-        logger.error(f"Error sending Slack notification for circular {data.get('circular_id')}: {e}")
-        if 'response' in locals() and response is not None: logger.error(f"Response content: {response.content}")
-        return False
\ No newline at end of file
+        logger.error("Error sending Slack notification for %s: %s", description, e)
+        if 'response' in locals() and response is not None: logger.error("Response content: %s", response.content)
+        return False
+
+def _retry_delay(attempt, retry_after=None):
+    """attempt回目 (0始まり) の失敗後に待つ秒数。Retry-Afterヘッダー (秒数) があればそれに従う"""
+    delay = SLACK_RETRY_BACKOFF_FACTOR * (2 ** attempt)
+    if retry_after:
+        try:
+            delay = max(delay, float(retry_after))
+        except ValueError:
+            pass # HTTP-date form: fall back to the exponential backoff
+    return min(delay, SLACK_MAX_RETRY_AFTER_SECONDS)
+
+async def _post_payload_async(http_session, payload, description):
+    """
+    _post_payload の非同期版。呼び出し側のaiohttp.ClientSessionを使い回す。
+    429/5xxと接続エラーは同期版のRetryと同じく最大SLACK_MAX_RETRIES回まで再送する。
+    """
+    if logger.isEnabledFor(logging.DEBUG): # Skip serializing the payload just for a discarded log line
+        logger.debug("Slack payload: %s", json.dumps(payload))
+    body, headers = _encode_body(payload)
+    for attempt in range(SLACK_MAX_RETRIES + 1):
+        retry_after = None
+        try:
+            async with http_session.post(SLACK_WEBHOOK_URL, data=body, headers=headers, timeout=aiohttp.ClientTimeout(total=30)) as response:
+                response_text = await response.text()
+                if response.status < 400:
+                    if response_text != "ok":
+                         logger.warning("Slack notification sent for %s, but response was not 'ok': %s", description, response_text)
+                    else:
+                        logger.info("Slack notification sent successfully for %s", description)
+                    return True
+                if response.status not in SLACK_RETRY_STATUSES or attempt == SLACK_MAX_RETRIES:
+                    logger.error("Error sending Slack notification for %s: HTTP %s", description, response.status)
+                    logger.error("Response content: %s", response_text)
+                    return False
+                retry_after = response.headers.get("Retry-After")
+                logger.warning("Slack returned HTTP %s for %s; retrying (%d/%d)", response.status, description, attempt + 1, SLACK_MAX_RETRIES)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == SLACK_MAX_RETRIES:
+                logger.error("Error sending Slack notification for %s: %s", description, e)
+                return False
+            logger.warning("Error sending Slack notification for %s: %s; retrying (%d/%d)", description, e, attempt + 1, SLACK_MAX_RETRIES)
+        await asyncio.sleep(_retry_delay(attempt, retry_after))
+    return False
+
+def send_slack_notification(data):
+    """抽出データを1件のSlackメッセージとして送信する (Slackが無効なら何もしない)"""
+    if not _SLACK_ENABLED:
+        logger.debug("SLACK_WEBHOOK_URL not set. Skipping notification.")
+        return False
+    return _post_payload(format_slack_message(data), f"circular {data.get('circular_id')}")
+
+class SlackBatcher:
+    """
+    複数のCircularの通知を溜めておき、区切り線で繋いだ1つのメッセージとしてまとめて送信する。
+    1メッセージあたりの件数はmax_batch_size件、ブロック数はSlackの上限 (50) までに分割する。
+    """
+
+    def __init__(self, max_batch_size=SLACK_BATCH_MAX_SIZE, batch_interval=SLACK_BATCH_INTERVAL_SECONDS):
+        self._max_batch_size = max_batch_size
+        self._batch_interval = batch_interval
+        self._messages = [] # (circular_id, payload)
+        self._first_added_at = None
+
+    def __len__(self):
+        return len(self._messages)
+
+    def add(self, data):
+        """通知を1件追加する (送信はflush_async時)"""
+        if not _SLACK_ENABLED:
+            logger.debug("SLACK_WEBHOOK_URL not set. Skipping notification.")
+            return
+        if not self._messages:
+            self._first_added_at = time.monotonic()
+        self._messages.append((data.get('circular_id'), format_slack_message(data)))
+
+    def is_due(self):
+        """件数が上限に達したか、最初の通知からbatch_interval秒以上経っていればTrue"""
+        if not self._messages:
+            return False
+        return len(self._messages) >= self._max_batch_size or time.monotonic() - self._first_added_at >= self._batch_interval
+
+    def _take_batches(self):
+        """溜まった通知を取り出し、上限に収まる (説明, ペイロード) のリストに分ける"""
+        messages, self._messages = self._messages, []
+        batches = []
+        circular_ids, blocks, texts = [], [], []
+
+        def close_batch():
+            description = f"circular {circular_ids[0]}" if len(circular_ids) == 1 else f"circulars {', '.join(str(c) for c in circular_ids)}"
+            payload = {
+                "username": SLACK_USERNAME,
+                "icon_emoji": SLACK_ICON_EMOJI,
+                "blocks": blocks,
+                "text": "\n".join(texts) # Fallback
+            }
+            if SLACK_CHANNEL:
+                payload["channel"] = SLACK_CHANNEL
+            batches.append((description, payload))
+
+        for circular_id, message in messages:
+            message_blocks = message["blocks"]
+            needed_blocks = len(message_blocks) + (1 if blocks else 0) # +1 for the divider between circulars
+            if circular_ids and (len(circular_ids) >= self._max_batch_size or len(blocks) + needed_blocks > SLACK_MAX_BLOCKS):
+                close_batch()
+                circular_ids, blocks, texts = [], [], []
+            if blocks:
+                blocks.append(_DIVIDER_BLOCK)
+            blocks.extend(message_blocks)
+            texts.append(message["text"])
+            circular_ids.append(circular_id)
+        if circular_ids:
+            close_batch()
+        return batches
+
+    async def flush_async(self, http_session):
+        """溜まった通知を呼び出し側のaiohttp.ClientSessionで送信する。全て送信できればTrue"""
+        all_sent = True
+        for description, payload in self._take_batches():
+            all_sent = await _post_payload_async(http_session, payload, description) and all_sent
+        return all_sent